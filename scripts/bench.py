@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import argparse
+import email
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+PDF_TEMPLATE = REPO_ROOT / "input_example" / "diploma.pdf"
+LOGO_FILE = REPO_ROOT / "input_example" / "nlpcreative.png"
+RESULTS_DIR = REPO_ROOT / "bench-results"
+CASES = ("overlay", "diploma_pdf", "diploma_jpg", "build_message", "parse_csv", "send_batch")
+DEFAULT_ITERATIONS = {"overlay": 200, "diploma_pdf": 100, "diploma_jpg": 50, "build_message": 300}
+DEFAULT_CSV_ROWS = "10,1000,10000,100000"
+DEFAULT_SEND_ROWS = "10,100,1000"
+CSV_REPEAT_ROWS = 200000
+HEBREW_FIRST = ["נועה", "איתי", "מיכל", "יונתן", "שירה", "אורי", "תמר", "דניאל", "רוני", "עומר"]
+HEBREW_LAST = ["כהן", "לוי", "מזרחי", "פרץ", "ביטון", "אברהם", "פרידמן", "שפירא", "אזולאי", "דהן"]
+LATIN_FIRST = ["Noa", "Itai", "Michal", "Jonathan", "Shira", "Uri", "Tamar", "Daniel", "Roni", "Omer"]
+LATIN_LAST = ["Cohen", "Levi", "Mizrahi", "Peretz", "Biton", "Abraham", "Friedman", "Shapiro", "Azulay", "Dahan"]
+LETTER_HTML = "<html><body dir=\"rtl\"><p>שלום {{name}},</p><p>מצורפת התעודה שלך.</p></body></html>"
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    arrivals: List[float] = []
+    latency = 0.0
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def reply(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self.reply(json.dumps({"emailAddress": "bench@example.com"}).encode("utf-8"), "application/json")
+
+    def do_POST(self) -> None:
+        data = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.path.startswith("/batch/"):
+            FakeGmailHandler.arrivals.append(time.perf_counter())
+            self.reply(b'{"id": "bench"}', "application/json")
+            return
+
+        envelope = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("ascii") + data
+        parts = []
+        for part in email.message_from_bytes(envelope).get_payload():
+            FakeGmailHandler.arrivals.append(time.perf_counter())
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(
+                f"--bench\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                "HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{\"id\": \"bench\"}\r\n"
+            )
+        self.reply(("".join(parts) + "--bench--").encode("ascii"), "multipart/mixed; boundary=bench")
+
+
+def start_fake_gmail(latency_ms: float) -> str:
+    FakeGmailHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGmailHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def make_names(count: int, hebrew_ratio: float, seed: int = 7) -> List[Tuple[str, str]]:
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        if rng.random() < hebrew_ratio:
+            names.append((rng.choice(HEBREW_FIRST), rng.choice(HEBREW_LAST)))
+        else:
+            names.append((rng.choice(LATIN_FIRST), rng.choice(LATIN_LAST)))
+    return names
+
+
+def make_roster(rows: int, hebrew_ratio: float) -> bytes:
+    lines = ["email,first,last,new,send"]
+    for idx, (first, last) in enumerate(make_names(rows, hebrew_ratio)):
+        lines.append(f"student{idx}@example.com,{first},{last},1,")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def make_jpg_template(path: Path) -> Path:
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (1240, 1754), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((60, 60, 1180, 1694), outline=(30, 60, 120), width=12)
+    draw.rectangle((120, 300, 1120, 420), fill=(235, 240, 250))
+    image.save(path, "JPEG", quality=90)
+    return path
+
+
+def percentile(samples: List[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+def time_calls(call: Callable[[int], Any], iterations: int) -> Tuple[float, List[float]]:
+    call(0)
+    latencies = []
+    started = time.perf_counter()
+    for iteration in range(iterations):
+        before = time.perf_counter()
+        call(iteration)
+        latencies.append(time.perf_counter() - before)
+    return time.perf_counter() - started, latencies
+
+
+def run_case(case: str, size: int, iterations: int, hebrew_ratio: float, gmail_latency_ms: float) -> Dict[str, Any]:
+    workdir = Path(tempfile.mkdtemp(prefix="diploma-bench-"))
+    try:
+        return measure_case(workdir, case, size, iterations, hebrew_ratio, gmail_latency_ms)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure_case(
+    workdir: Path,
+    case: str,
+    size: int,
+    iterations: int,
+    hebrew_ratio: float,
+    gmail_latency_ms: float,
+) -> Dict[str, Any]:
+    os.environ.setdefault("DIPLOMA_SENT_LEDGER", "0")
+    os.environ.setdefault("DIPLOMA_JANITOR_INTERVAL_SECONDS", "0")
+    os.environ.setdefault("DIPLOMA_JOBS_AUTO_RESUME", "0")
+    os.environ.setdefault("DIPLOMA_SEND_RATE", "100000")
+    os.environ.setdefault("DIPLOMA_SEND_RATE_MAX", "100000")
+    if case == "send_batch":
+        os.environ["DIPLOMA_GMAIL_API_ENDPOINT"] = start_fake_gmail(gmail_latency_ms)
+
+    sys.path.insert(0, str(REPO_ROOT))
+    from webappGamilAPI import app as diploma_app
+
+    diploma_app.OUTPUT_DIR = workdir / "output"
+    diploma_app.ASSETS_DIR = workdir / "assets"
+    diploma_app.JOBS_DIR = workdir / "jobs"
+    diploma_app.JOBS_DB = diploma_app.JOBS_DIR / "jobs.sqlite3"
+    names = [f"{first} {last}" for first, last in make_names(max(size, iterations, 1), hebrew_ratio)]
+    result: Dict[str, Any] = {"case": case, "size": size}
+
+    if case == "overlay":
+        elapsed, latencies = time_calls(lambda i: diploma_app.make_overlay_pdf(names[i]), iterations)
+        result.update(unit="diplomas", count=iterations)
+    elif case == "diploma_pdf":
+        elapsed, latencies = time_calls(
+            lambda i: diploma_app.generate_diploma_pdf(PDF_TEMPLATE, names[i], workdir / "pdf"), iterations
+        )
+        result.update(unit="diplomas", count=iterations)
+    elif case == "diploma_jpg":
+        jpg_template = make_jpg_template(workdir / "template.jpg")
+        elapsed, latencies = time_calls(
+            lambda i: diploma_app.generate_diploma_jpg(jpg_template, names[i], workdir / "jpg"), iterations
+        )
+        result.update(unit="diplomas", count=iterations)
+    elif case == "build_message":
+        pdf_path = diploma_app.generate_diploma_pdf(PDF_TEMPLATE, names[0], workdir / "pdf")
+        pdf_attachment = (pdf_path.name, pdf_path.read_bytes())
+        logo_bytes = LOGO_FILE.read_bytes()
+        html = diploma_app.inject_logo_cid(LETTER_HTML)
+        elapsed, latencies = time_calls(
+            lambda i: diploma_app.build_message(
+                names[i],
+                f"student{i}@example.com",
+                html,
+                "",
+                "bench@example.com",
+                None,
+                None,
+                logo_bytes=logo_bytes,
+                logo_filename=LOGO_FILE.name,
+                pdf_attachment=pdf_attachment,
+            ).as_bytes(),
+            iterations,
+        )
+        result.update(unit="messages", count=iterations)
+    elif case == "parse_csv":
+        content = make_roster(size, hebrew_ratio)
+        repeats = iterations or max(3, min(200, CSV_REPEAT_ROWS // max(size, 1)))
+        elapsed, latencies = time_calls(lambda i: diploma_app.parse_csv(content), repeats)
+        result.update(unit="rows", count=size * repeats, bytes=len(content))
+    elif case == "send_batch":
+        from fastapi.testclient import TestClient
+        from google.oauth2.credentials import Credentials
+
+        diploma_app.load_credentials = lambda: Credentials(token="bench")
+        client = TestClient(diploma_app.app)
+        content = make_roster(size, hebrew_ratio)
+        files = {
+            "csv_file": ("roster.csv", content, "text/csv"),
+            "pdf_template": (PDF_TEMPLATE.name, PDF_TEMPLATE.read_bytes(), "application/pdf"),
+            "logo_file": (LOGO_FILE.name, LOGO_FILE.read_bytes(), "image/png"),
+        }
+        started = time.perf_counter()
+        response = client.post("/api/send", files=files, data={"html_content": LETTER_HTML})
+        elapsed = time.perf_counter() - started
+        payload = response.json()
+        if not payload.get("ok"):
+            raise RuntimeError(payload.get("error", f"HTTP {response.status_code}"))
+        arrivals = [started] + FakeGmailHandler.arrivals[:-1]
+        latencies = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+        result.update(
+            unit="messages",
+            count=payload["summary"]["sent"],
+            errors=len(payload["errors"]),
+            render_workers=diploma_app.get_render_workers(),
+            batch_size=diploma_app.get_gmail_batch_size(),
+        )
+    else:
+        raise ValueError(f"Unknown case: {case}")
+
+    result.update(
+        seconds=round(elapsed, 4),
+        throughput_per_s=round(result["count"] / elapsed, 2) if elapsed else None,
+        p50_ms=round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        peak_rss_mb=peak_rss_mb(),
+    )
+    return result
+
+
+def run_isolated(case: str, size: int, args: argparse.Namespace) -> Dict[str, Any]:
+    command = [
+        sys.executable,
+        str(Path(__file__).resolve()),
+        "--case",
+        case,
+        "--size",
+        str(size),
+        "--iterations",
+        str(args.iterations if args.iterations is not None else DEFAULT_ITERATIONS.get(case, 0)),
+        "--hebrew-ratio",
+        str(args.hebrew_ratio),
+        "--gmail-latency-ms",
+        str(args.gmail_latency_ms),
+    ]
+    completed = subprocess.run(command, capture_output=True, text=True, cwd=str(REPO_ROOT))
+    lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+    if completed.returncode != 0 or not lines:
+        error = (completed.stderr.strip().splitlines() or ["no output"])[-1]
+        return {"case": case, "size": size, "error": error}
+    return json.loads(lines[-1])
+
+
+def git_revision() -> str:
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=str(REPO_ROOT)
+        )
+    except OSError:
+        return ""
+    return completed.stdout.strip()
+
+
+def format_row(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> str:
+    label = f"{result['case']}[{result['size']}]" if result.get("size") else result["case"]
+    if "error" in result:
+        return f"{label:<24} ERROR {result['error']}"
+    line = (
+        f"{label:<24} {result['throughput_per_s']:>12,.1f} {result['unit']}/s"
+        f"  p50 {result['p50_ms']:>9.3f} ms  p99 {result['p99_ms']:>9.3f} ms"
+        f"  rss {result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-':>7} MB"
+    )
+    if baseline and baseline.get("throughput_per_s"):
+        change = (result["throughput_per_s"] / baseline["throughput_per_s"] - 1) * 100
+        line += f"  {change:+.1f}% vs baseline"
+    return line
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark diploma rendering, MIME building, CSV parsing and the /api/send loop against a fake Gmail."
+    )
+    parser.add_argument("--cases", default=",".join(CASES), help=f"comma separated subset of {', '.join(CASES)}")
+    parser.add_argument("--csv-rows", default=DEFAULT_CSV_ROWS, help="roster sizes for parse_csv")
+    parser.add_argument("--send-rows", default=DEFAULT_SEND_ROWS, help="roster sizes for send_batch")
+    parser.add_argument("--iterations", type=int, default=None, help="calls per micro benchmark")
+    parser.add_argument("--hebrew-ratio", type=float, default=0.5, help="share of Hebrew names in synthetic data")
+    parser.add_argument("--gmail-latency-ms", type=float, default=0.0, help="delay added by the fake Gmail server")
+    parser.add_argument("--output", default="", help="JSON results path (default bench-results/bench-<time>.json)")
+    parser.add_argument("--compare", default="", help="previous JSON results to compare throughput against")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.size, args.iterations or 0, args.hebrew_ratio, args.gmail_latency_ms)))
+        return 0
+
+    cases = [case.strip() for case in args.cases.split(",") if case.strip()]
+    unknown = sorted(set(cases) - set(CASES))
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+    baseline: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    if args.compare:
+        previous = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        baseline = {(item["case"], item.get("size", 0)): item for item in previous.get("results", [])}
+
+    results = []
+    for case in cases:
+        if case == "parse_csv":
+            sizes = [int(value) for value in args.csv_rows.split(",") if value.strip()]
+        elif case == "send_batch":
+            sizes = [int(value) for value in args.send_rows.split(",") if value.strip()]
+        else:
+            sizes = [0]
+        for size in sizes:
+            result = run_isolated(case, size, args)
+            results.append(result)
+            print(format_row(result, baseline.get((case, size))), flush=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "hebrew_ratio": args.hebrew_ratio,
+        "gmail_latency_ms": args.gmail_latency_ms,
+        "env": {key: value for key, value in sorted(os.environ.items()) if key.startswith("DIPLOMA_")},
+        "results": results,
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"Results written to {output}")
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+import zipfile
+from io import BytesIO
+from pathlib import Path
+
+import PyPDF2
+
+from webappGamilAPI import app
+
+TEMPLATE = Path(__file__).resolve().parent.parent / "input_example" / "diploma.pdf"
+NAMES = ["Ada Lovelace", "Alan Turing", "Grace Hopper"]
+STUDENTS = [(idx, {"name": name, "email": f"{idx}@example.com"}) for idx, name in enumerate(NAMES)]
+
+
+def read_pdf(data: bytes) -> PyPDF2.PdfReader:
+    assert b"0000000000 00000 n" not in data
+    reader = PyPDF2.PdfReader(BytesIO(data), strict=True)
+    for page in reader.pages:
+        page.extract_text()
+    return reader
+
+
+def test_merged_pdf_export_has_one_page_per_student():
+    reader = read_pdf(b"".join(app.iter_export_pdf(STUDENTS, TEMPLATE)))
+    assert len(reader.pages) == len(STUDENTS)
+    assert "Diplomas not rendered" not in reader.pages[-1].extract_text()
+
+
+def test_merged_pdf_export_lists_rows_that_fail_to_merge(monkeypatch):
+    add_form = app.MergedPdfWriter.add_form
+    calls = []
+
+    def broken_write_object(ref, obj):
+        raise ValueError("broken overlay")
+
+    def failing_add_form(self, page, refs):
+        calls.append(page)
+        if len(calls) == 2:
+            self.write_object = broken_write_object
+        try:
+            return add_form(self, page, refs)
+        finally:
+            self.__dict__.pop("write_object", None)
+
+    monkeypatch.setattr(app.MergedPdfWriter, "add_form", failing_add_form)
+    reader = read_pdf(b"".join(app.iter_export_pdf(STUDENTS, TEMPLATE)))
+    assert len(reader.pages) == len(STUDENTS)
+    assert "Alan Turing" in reader.pages[0].extract_text()
+    text = reader.pages[-1].extract_text()
+    assert "Diplomas not rendered: 1" in text
+    assert "0    Ada Lovelace    broken overlay" in text
+
+
+def test_zip_export_contains_every_attachment():
+    rendered = [(idx, student, (f"{idx}.pdf", b"%PDF"), None, None) for idx, student in STUDENTS]
+    rendered.append((3, {"name": "Broken"}, None, None, "no template"))
+    with zipfile.ZipFile(BytesIO(b"".join(app.iter_export_zip(rendered)))) as archive:
+        assert archive.namelist() == ["00001_0.pdf", "00002_1.pdf", "00003_2.pdf", "errors.txt"]
+        assert archive.read("errors.txt") == b"3\tBroken\tno template\n"
+
@@ -1,42 +1,75 @@
 from __future__ import annotations
 
+import asyncio
 import base64
+import bisect
+import codecs
 import csv
+import functools
+import hashlib
 import html as html_lib
 import io
+import itertools
 import json
+import multiprocessing
 import os
+import random
 import re
+import shutil
+import sqlite3
+import sys
+import threading
 import time
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
+from email.header import Header
 from email.mime.application import MIMEApplication
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from io import BytesIO
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, List, Dict, Iterable, Iterator, Tuple, Optional
 
-from fastapi import FastAPI, File, Form, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, File, Form, Header as HeaderParam, UploadFile
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from fastapi.requests import Request
-from google.auth.transport.requests import Request as GoogleRequest
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-try:
-    from pdf2image import convert_from_path
-except Exception:  # noqa: BLE001
-    convert_from_path = None
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, features
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 import PyPDF2
+from PyPDF2.generic import (
+    ArrayObject,
+    ContentStream,
+    DictionaryObject,
+    EncodedStreamObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+)
+
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
 
+Attachment = Tuple[str, bytes]
 
 APP_DIR = Path(__file__).resolve().parent
 REPO_DIR = APP_DIR.parent
@@ -56,13 +89,134 @@ CLIENT_SECRETS = APP_DIR / "client_secret.json"
 CLIENT_SECRETS_ENV = "GMAIL_CLIENT_SECRET_PATH"
 TOKEN_DIR = APP_DIR / ".tokens"
 TOKEN_FILE = TOKEN_DIR / "gmail_token.json"
+TOKEN_LOCK_FILE = TOKEN_DIR / "gmail_token.lock"
+OAUTH_STATE_TTL_SECONDS = 600
+CREDENTIAL_CACHE_ENV = "DIPLOMA_CREDENTIAL_CACHE"
+CREDENTIAL_RECHECK_SECONDS = 5.0
+CREDENTIAL_REFRESH_MARGIN_SECONDS = 300.0
+CREDENTIAL_REFRESH_RETRY_SECONDS = 30.0
+CREDENTIAL_IDLE_SECONDS = 300.0
+ASSETS_DIR = APP_DIR / ".assets"
+ASSET_ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+JOBS_DIR = APP_DIR / ".jobs"
+JOBS_DB = JOBS_DIR / "jobs.sqlite3"
+JOBS_AUTO_RESUME_ENV = "DIPLOMA_JOBS_AUTO_RESUME"
+JOB_POLL_SECONDS = 1.0
+JOB_STREAM_POLL_SECONDS = 0.5
+JOB_HEARTBEAT_SECONDS = 10.0
+JOB_LEASE_SECONDS = 60.0
+SENT_LEDGER_ENV = "DIPLOMA_SENT_LEDGER"
+LEDGER_LOOKUP_BATCH = 500
+OUTPUT_RETENTION = {
+    "preview": ("DIPLOMA_RETENTION_PREVIEW_HOURS", 24.0),
+    "test": ("DIPLOMA_RETENTION_TEST_HOURS", 168.0),
+    "batch": ("DIPLOMA_RETENTION_BATCH_HOURS", 720.0),
+    "asset": ("DIPLOMA_RETENTION_ASSET_HOURS", 720.0),
+}
+OUTPUT_MAX_MB_ENV = "DIPLOMA_OUTPUT_MAX_MB"
+OUTPUT_MAX_MB_DEFAULT = 2048
+OUTPUT_MIN_AGE_SECONDS = 600
+JANITOR_INTERVAL_ENV = "DIPLOMA_JANITOR_INTERVAL_SECONDS"
+JANITOR_INTERVAL_DEFAULT = 900
+JOB_TERMINAL_STATUSES = {"completed", "failed", "interrupted"}
 DISABLE_JPG_ENV = "DIPLOMA_DISABLE_JPG"
+RASTER_DPI_ENV = "DIPLOMA_RASTER_DPI"
+RASTER_DPI_DEFAULT = 150
+RASTER_THREADS_ENV = "DIPLOMA_RASTER_THREADS"
+TEMPLATE_CACHE_MB_ENV = "DIPLOMA_TEMPLATE_CACHE_MB"
+TEMPLATE_CACHE_DEFAULT_MB = 64
+PDF_OPTIMIZE_ENV = "DIPLOMA_PDF_OPTIMIZE"
+PDF_IMAGE_DPI_ENV = "DIPLOMA_PDF_IMAGE_DPI"
+PDF_IMAGE_QUALITY_ENV = "DIPLOMA_PDF_IMAGE_QUALITY"
+PDF_IMAGE_MODES = {"/DeviceGray": "L", "/DeviceRGB": "RGB", "/DeviceCMYK": "CMYK"}
+PDF_FORM_DEPTH = 8
+RENDER_WORKERS_ENV = "DIPLOMA_RENDER_WORKERS"
+RENDER_CHUNK_SIZE = 16
+FONT_SUBSET_ENV = "DIPLOMA_FONT_SUBSET"
+FONT_SUBSET_MODES = ("chunk", "name")
+FONT_REPORT_SAMPLE = 32
+EXPORT_FORMATS = {"zip": "application/zip", "pdf": "application/pdf"}
+EXPORT_ERROR_LINES = 40
+EXPORT_ERROR_CHARS = 110
+CSV_SNIFF_BYTES = 64 * 1024
+PREVIEW_FILTERS = {"all", "eligible", "ineligible"}
+PERSIST_OUTPUT_ENV = "DIPLOMA_PERSIST_OUTPUT"
+SEND_CONCURRENCY_ENV = "DIPLOMA_SEND_CONCURRENCY"
+SEND_CONCURRENCY_DEFAULT = 4
+GMAIL_SERVICE_CACHE_ENV = "DIPLOMA_GMAIL_SERVICE_CACHE"
+GMAIL_BATCH_SIZE_ENV = "DIPLOMA_GMAIL_BATCH_SIZE"
+GMAIL_BATCH_LIMIT = 100
+GMAIL_API_ENDPOINT_ENV = "DIPLOMA_GMAIL_API_ENDPOINT"
+COMPILED_MESSAGES_ENV = "DIPLOMA_COMPILED_MESSAGES"
+METRICS_ENV = "DIPLOMA_METRICS"
+PROFILE_ENV = "DIPLOMA_PROFILE"
+PROFILE_INTERVAL_ENV = "DIPLOMA_PROFILE_INTERVAL_MS"
+PROFILE_INTERVAL_DEFAULT_MS = 5.0
+PROFILE_TOP_FUNCTIONS = 40
+WARM_UP_ENV = "DIPLOMA_WARM_UP"
+WARM_UP_NAMES = ("Warm Up", "חימום")
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_COUNTERS = {
+    "messages_sent": "Messages accepted by Gmail.",
+    "rows_skipped": "Roster rows skipped as ineligible or already sent.",
+    "send_errors": "Rows that failed to render or send.",
+    "send_retries": "Messages retried after throttling or transient errors.",
+    "attachment_bytes": "Attachment bytes in sent messages.",
+    "csv_rows": "Roster rows parsed for sends.",
+    "messages_built": "MIME messages built.",
+    "message_bytes": "Bytes of MIME messages built.",
+    "gmail_service_builds": "Gmail API clients built.",
+    "gmail_service_reuses": "Gmail API client cache hits.",
+}
+SEND_RATE_ENV = "DIPLOMA_SEND_RATE"
+SEND_RATE_MAX_ENV = "DIPLOMA_SEND_RATE_MAX"
+SEND_MAX_RETRIES_ENV = "DIPLOMA_SEND_MAX_RETRIES"
+SEND_RATE_DEFAULT = 5.0
+SEND_RATE_MAX_DEFAULT = 20.0
+SEND_RATE_MIN = 0.2
+SEND_RATE_STEP = 0.1
+SEND_MAX_RETRIES_DEFAULT = 5
+SEND_BACKOFF_BASE = 1.0
+SEND_BACKOFF_CAP = 32.0
+TRANSIENT_HTTP_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_REASONS = ("ratelimitexceeded", "userratelimitexceeded", "too many concurrent requests")
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.send",
     "https://www.googleapis.com/auth/gmail.readonly",
 ]
-OAUTH_STATE: str | None = None
-OAUTH_REDIRECT_URI: str | None = None
+TEMPLATE_CACHE: "OrderedDict[str, Tuple[PyPDF2.PdfReader, int]]" = OrderedDict()
+TEMPLATE_HASHES: Dict[Tuple[str, int, int], str] = {}
+TEMPLATE_CACHE_LOCK = threading.RLock()
+PDF_OPTIMIZE_REPORTS: Dict[str, Dict[str, Any]] = {}
+IMAGE_CACHE: "OrderedDict[Tuple[str, int], Image.Image]" = OrderedDict()
+IMAGE_CACHE_LOCK = threading.Lock()
+GMAIL_SERVICES: Dict[Tuple[int, str], Any] = {}
+GMAIL_SERVICES_LOCK = threading.Lock()
+GMAIL_STATS = {"builds": 0, "reuses": 0, "build_seconds": 0.0, "sends": 0, "send_seconds": 0.0}
+MESSAGE_STATS = {"messages": 0, "message_seconds": 0.0, "message_bytes": 0}
+CREDENTIAL_CACHE: Dict[str, Any] = {"loaded": False, "credentials": None, "stamp": None, "checked_at": 0.0}
+SENDER_PROFILES: Dict[str, str] = {}
+CREDENTIAL_LOCK = threading.Lock()
+CREDENTIAL_STATS = {"hits": 0, "loads": 0, "background_refreshes": 0, "profile_hits": 0, "profile_lookups": 0}
+CREDENTIAL_WAKEUP = threading.Event()
+CREDENTIAL_REFRESHER: threading.Thread | None = None
+STAGE_METRICS: Dict[str, List[float]] = {}
+COUNTER_METRICS: Dict[str, float] = {}
+METRICS_LOCK = threading.Lock()
+ACTIVE_PROFILER: "ContextVar[Optional[RunProfiler]]" = ContextVar("diploma_profiler", default=None)
+JOB_WAKEUP = threading.Event()
+JOB_WORKER: threading.Thread | None = None
+JANITOR_LOCK = threading.Lock()
+JANITOR_WORKER: threading.Thread | None = None
+WARM_UP_WORKER: threading.Thread | None = None
+STARTUP_LOCK = threading.Lock()
+STARTUP_STATS: Dict[str, Any] = {
+    "import_seconds": IMPORT_SECONDS,
+    "warm_up": {},
+    "warm_up_seconds": None,
+    "first_preview_seconds": None,
+    "first_preview_since_import_seconds": None,
+}
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory=APP_DIR / "static"), name="static")
@@ -75,6 +229,230 @@ def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
+def metrics_enabled() -> bool:
+    return os.environ.get(METRICS_ENV, "1").strip().lower() not in {"0", "false", "no"}
+
+
+def observe_stage(stage: str, seconds: float, count: int = 1) -> None:
+    if not count or not metrics_enabled():
+        return
+    bucket = bisect.bisect_left(STAGE_BUCKETS, seconds / count)
+    with METRICS_LOCK:
+        metric = STAGE_METRICS.get(stage)
+        if metric is None:
+            metric = STAGE_METRICS[stage] = [0.0] * (len(STAGE_BUCKETS) + 3)
+        metric[0] += count
+        metric[1] += seconds
+        metric[2 + bucket] += count
+
+
+def increment_metric(name: str, value: float = 1) -> None:
+    if not value or not metrics_enabled():
+        return
+    with METRICS_LOCK:
+        COUNTER_METRICS[name] = COUNTER_METRICS.get(name, 0) + value
+
+
+def timed_stage(stage: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_stage(stage, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def drain_metrics() -> Tuple[Dict[str, List[float]], Dict[str, float]]:
+    with METRICS_LOCK:
+        stages = dict(STAGE_METRICS)
+        counters = dict(COUNTER_METRICS)
+        STAGE_METRICS.clear()
+        COUNTER_METRICS.clear()
+    return stages, counters
+
+
+def merge_metrics(stages: Dict[str, List[float]], counters: Dict[str, float]) -> None:
+    with METRICS_LOCK:
+        for stage, values in stages.items():
+            metric = STAGE_METRICS.setdefault(stage, [0.0] * len(values))
+            for index, value in enumerate(values):
+                metric[index] += value
+        for name, value in counters.items():
+            COUNTER_METRICS[name] = COUNTER_METRICS.get(name, 0) + value
+
+
+def format_metric_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_metrics() -> str:
+    with METRICS_LOCK:
+        stages = {stage: list(values) for stage, values in STAGE_METRICS.items()}
+        counters = dict(COUNTER_METRICS)
+    with GMAIL_SERVICES_LOCK:
+        counters["gmail_service_builds"] = GMAIL_STATS["builds"]
+        counters["gmail_service_reuses"] = GMAIL_STATS["reuses"]
+        counters["messages_built"] = MESSAGE_STATS["messages"]
+        counters["message_bytes"] = MESSAGE_STATS["message_bytes"]
+
+    lines = [
+        "# HELP diploma_stage_seconds Time spent per batch pipeline stage.",
+        "# TYPE diploma_stage_seconds histogram",
+    ]
+    for stage in sorted(stages):
+        values = stages[stage]
+        cumulative = 0.0
+        for bound, count in zip(STAGE_BUCKETS + (float("inf"),), values[2:]):
+            cumulative += count
+            label = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'diploma_stage_seconds_bucket{{stage="{stage}",le="{label}"}} {format_metric_value(cumulative)}')
+        lines.append(f'diploma_stage_seconds_sum{{stage="{stage}"}} {format_metric_value(values[1])}')
+        lines.append(f'diploma_stage_seconds_count{{stage="{stage}"}} {format_metric_value(values[0])}')
+    for name, description in METRIC_COUNTERS.items():
+        lines.append(f"# HELP diploma_{name}_total {description}")
+        lines.append(f"# TYPE diploma_{name}_total counter")
+        lines.append(f"diploma_{name}_total {format_metric_value(counters.get(name, 0))}")
+    return "\n".join(lines) + "\n"
+
+
+def profiling_requested(*flags: str) -> bool:
+    values = (os.environ.get(PROFILE_ENV, ""),) + flags
+    return any(value.strip().lower() in {"1", "true", "yes", "on"} for value in values)
+
+
+def get_profile_interval() -> float:
+    try:
+        milliseconds = float(os.environ.get(PROFILE_INTERVAL_ENV, "").strip() or PROFILE_INTERVAL_DEFAULT_MS)
+    except ValueError:
+        milliseconds = PROFILE_INTERVAL_DEFAULT_MS
+    return max(1.0, milliseconds) / 1000
+
+
+class RunProfiler:
+    def __init__(self, run_dir: Path, enabled: bool) -> None:
+        self.run_dir = run_dir
+        self.enabled = enabled
+        self.interval = get_profile_interval()
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.started = 0.0
+        self.duration = 0.0
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.report: Optional[Dict[str, Any]] = None
+        self.lock = threading.Lock()
+        self.thread_ids: Dict[int, int] = {}
+        self.owner_id = 0
+        self.context_token = None
+
+    def __enter__(self) -> "RunProfiler":
+        if self.enabled:
+            self.started = time.perf_counter()
+            self.owner_id = threading.get_ident()
+            self.context_token = ACTIVE_PROFILER.set(self)
+            self.thread = threading.Thread(target=self.sample, name="diploma-profiler", daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> bool:
+        if self.thread is None:
+            return False
+        try:
+            ACTIVE_PROFILER.reset(self.context_token)
+        except ValueError:
+            # An async generator finalized after a disconnect exits in a different context.
+            pass
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.duration = time.perf_counter() - self.started
+        try:
+            self.report = self.write()
+        except OSError as exc:
+            self.report = {"error": str(exc)}
+        return False
+
+    @contextmanager
+    def track_thread(self) -> Iterator[None]:
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.thread_ids[thread_id] = self.thread_ids.get(thread_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.thread_ids[thread_id] -= 1
+                if not self.thread_ids[thread_id]:
+                    del self.thread_ids[thread_id]
+
+    def sample(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                run_threads = set(self.thread_ids)
+            run_threads.add(self.owner_id)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in run_threads:
+                    continue
+                stack = []
+                relevant = False
+                while frame is not None:
+                    code = frame.f_code
+                    relevant = relevant or code.co_filename == __file__
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if relevant:
+                    key = ";".join(reversed(stack))
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                    self.samples += 1
+
+    def write(self) -> Dict[str, Any]:
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        folded_path = self.run_dir / "profile.folded"
+        summary_path = self.run_dir / "profile.txt"
+        folded_path.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items())), encoding="utf-8"
+        )
+
+        own: Dict[str, int] = {}
+        total: Dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total[frame] = total.get(frame, 0) + count
+        lines = [
+            f"samples: {self.samples}  interval: {self.interval * 1000:g} ms  duration: {self.duration:.2f} s",
+            "",
+            f"{'self%':>7} {'total%':>7}  function",
+        ]
+        scale = 100 / max(self.samples, 1)
+        ranked = sorted(total.items(), key=lambda item: (-own.get(item[0], 0), -item[1]))
+        for frame, count in ranked[:PROFILE_TOP_FUNCTIONS]:
+            lines.append(f"{own.get(frame, 0) * scale:>6.1f}% {count * scale:>6.1f}%  {frame}")
+        summary_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return {
+            "path": str(self.run_dir),
+            "folded_url": f"/output/{self.run_dir.name}/{folded_path.name}",
+            "summary_url": f"/output/{self.run_dir.name}/{summary_path.name}",
+            "samples": self.samples,
+            "duration_seconds": round(self.duration, 3),
+        }
+
+
+def call_profiled(func: Callable[..., Any], *args: Any) -> Any:
+    profiler = ACTIVE_PROFILER.get()
+    if profiler is None:
+        return func(*args)
+    with profiler.track_thread():
+        return func(*args)
+
+
 def register_font_once() -> None:
     global ACTIVE_FONT_NAME, ACTIVE_FONT_PATH
     if ACTIVE_FONT_NAME and ACTIVE_FONT_NAME in pdfmetrics.getRegisteredFontNames():
@@ -122,10 +500,7 @@ def is_hebrew(text: str) -> bool:
     return any("\u0590" <= char <= "\u05FF" for char in text)
 
 
-def make_overlay_pdf(student_name: str, x_offset: int = 0, y_offset: int = 0) -> BytesIO:
-    register_font_once()
-    packet = BytesIO()
-    can = canvas.Canvas(packet, pagesize=letter)
+def draw_overlay_name(can: canvas.Canvas, student_name: str, x_offset: int = 0, y_offset: int = 0) -> None:
     width, height = letter
 
     display_name = student_name[::-1] if is_hebrew(student_name) else student_name
@@ -133,12 +508,484 @@ def make_overlay_pdf(student_name: str, x_offset: int = 0, y_offset: int = 0) ->
 
     can.setFont(get_active_font(), 42)
     can.drawCentredString(width / 2.0 + x_offset, height - name_y_offset + y_offset, display_name)
+
+
+@timed_stage("overlay")
+def make_overlay_pdf(student_name: str, x_offset: int = 0, y_offset: int = 0) -> BytesIO:
+    register_font_once()
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=letter)
+    draw_overlay_name(can, student_name, x_offset=x_offset, y_offset=y_offset)
     can.save()
 
     packet.seek(0)
     return packet
 
 
+def make_overlay_pdf_batch(student_names: List[str], x_offset: int = 0, y_offset: int = 0) -> BytesIO:
+    register_font_once()
+    started = time.perf_counter()
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=letter)
+    for student_name in student_names:
+        draw_overlay_name(can, student_name, x_offset=x_offset, y_offset=y_offset)
+        can.showPage()
+    can.save()
+    observe_stage("overlay", time.perf_counter() - started, len(student_names))
+
+    packet.seek(0)
+    return packet
+
+
+def get_font_subset_mode() -> str:
+    mode = os.environ.get(FONT_SUBSET_ENV, "").strip().lower()
+    return mode if mode in FONT_SUBSET_MODES else FONT_SUBSET_MODES[0]
+
+
+def render_overlay_pages(
+    student_names: List[str],
+    x_offset: int = 0,
+    y_offset: int = 0,
+    subset_mode: Optional[str] = None,
+) -> List[PyPDF2.PageObject]:
+    if not student_names:
+        return []
+    if (subset_mode or get_font_subset_mode()) == "name":
+        return [
+            PyPDF2.PdfReader(make_overlay_pdf(student_name, x_offset=x_offset, y_offset=y_offset)).pages[0]
+            for student_name in student_names
+        ]
+    overlay_pdf = PyPDF2.PdfReader(make_overlay_pdf_batch(student_names, x_offset=x_offset, y_offset=y_offset))
+    return list(overlay_pdf.pages)
+
+
+def overlay_font_bytes(overlay_page: PyPDF2.PageObject) -> int:
+    total = 0
+    resources = overlay_page.get("/Resources")
+    fonts = resources.get_object().get("/Font") if resources else None
+    for font in (fonts.get_object().values() if fonts else []):
+        descriptor = font.get_object().get("/FontDescriptor")
+        font_file = descriptor.get_object().get("/FontFile2") if descriptor else None
+        if font_file is not None:
+            total += len(font_file.get_object()._data)
+    return total
+
+
+def font_subset_report(
+    pdf_template_path: Path,
+    student_names: List[str],
+    x_offset: int = 0,
+    y_offset: int = 0,
+) -> Dict[str, Any]:
+    report = {}
+    for mode in FONT_SUBSET_MODES:
+        started = time.perf_counter()
+        overlay_pages = render_overlay_pages(student_names, x_offset, y_offset, subset_mode=mode)
+        overlay_seconds = time.perf_counter() - started
+        pdf_sizes = [len(render_diploma_pdf(pdf_template_path, page)) for page in overlay_pages]
+        font_sizes = [overlay_font_bytes(page) for page in overlay_pages]
+        report[mode] = {
+            "avg_pdf_bytes": round(sum(pdf_sizes) / len(pdf_sizes)),
+            "max_pdf_bytes": max(pdf_sizes),
+            "avg_font_bytes": round(sum(font_sizes) / len(font_sizes)),
+            "avg_overlay_ms": round(overlay_seconds * 1000 / len(student_names), 3),
+        }
+    return report
+
+
+def get_template_cache_limit() -> int:
+    value = os.environ.get(TEMPLATE_CACHE_MB_ENV, "").strip()
+    try:
+        megabytes = float(value) if value else TEMPLATE_CACHE_DEFAULT_MB
+    except ValueError:
+        megabytes = TEMPLATE_CACHE_DEFAULT_MB
+    return int(max(0.0, megabytes) * 1024 * 1024)
+
+
+def file_content_hash(path: Path) -> str:
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    digest = TEMPLATE_HASHES.get(key)
+    if digest is None:
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        TEMPLATE_HASHES[key] = digest
+    return digest
+
+
+def pdf_optimize_enabled() -> bool:
+    return os.environ.get(PDF_OPTIMIZE_ENV, "1").strip().lower() not in {"0", "false", "no"}
+
+
+def get_pdf_image_dpi() -> int:
+    try:
+        return max(0, int(os.environ.get(PDF_IMAGE_DPI_ENV, "").strip() or 0))
+    except ValueError:
+        return 0
+
+
+def get_pdf_image_quality() -> int:
+    try:
+        return min(95, max(0, int(os.environ.get(PDF_IMAGE_QUALITY_ENV, "").strip() or 0)))
+    except ValueError:
+        return 0
+
+
+def get_pdf_optimize_key() -> str:
+    if not pdf_optimize_enabled():
+        return "raw"
+    return f"dpi={get_pdf_image_dpi()}:q={get_pdf_image_quality()}"
+
+
+def multiply_matrix(first: List[float], second: List[float]) -> List[float]:
+    a, b, c, d, e, f = first
+    g, h, i, j, k, l = second
+    return [a * g + b * i, a * h + b * j, c * g + d * i, c * h + d * j, e * g + f * i + k, e * h + f * j + l]
+
+
+def image_placements(
+    pdf: Any,
+    content: Any,
+    resources: Any,
+    matrix: List[float],
+    placements: Dict[int, Tuple[float, float]],
+    depth: int = 0,
+) -> Dict[int, Tuple[float, float]]:
+    resources = resources.get_object() if resources is not None else DictionaryObject()
+    xobjects = resources.get("/XObject")
+    xobjects = xobjects.get_object() if xobjects is not None else DictionaryObject()
+    stack = []
+    current = matrix
+    for operands, operator in ContentStream(content, pdf).operations:
+        if operator == b"q":
+            stack.append(current)
+        elif operator == b"Q":
+            current = stack.pop() if stack else matrix
+        elif operator == b"cm":
+            current = multiply_matrix([float(value) for value in operands], current)
+        elif operator == b"Do":
+            reference = xobjects.get(operands[0])
+            if not isinstance(reference, IndirectObject):
+                continue
+            xobject = reference.get_object()
+            if xobject.get("/Subtype") == "/Image":
+                width = (current[0] ** 2 + current[1] ** 2) ** 0.5
+                height = (current[2] ** 2 + current[3] ** 2) ** 0.5
+                placed = placements.get(reference.idnum, (0.0, 0.0))
+                placements[reference.idnum] = (max(placed[0], width), max(placed[1], height))
+            elif xobject.get("/Subtype") == "/Form" and depth < PDF_FORM_DEPTH:
+                form_matrix = [float(value) for value in xobject.get("/Matrix", [1, 0, 0, 1, 0, 0])]
+                image_placements(
+                    pdf,
+                    xobject,
+                    xobject.get("/Resources", resources),
+                    multiply_matrix(form_matrix, current),
+                    placements,
+                    depth + 1,
+                )
+    return placements
+
+
+def decode_pdf_image(image: StreamObject) -> Optional[Image.Image]:
+    if image.get("/BitsPerComponent") != 8 or image.get("/ImageMask") or "/Decode" in image:
+        return None
+    image_filter = image.get("/Filter")
+    if isinstance(image_filter, ArrayObject):
+        image_filter = image_filter[0] if len(image_filter) == 1 else "/Unsupported"
+    colorspace = image.get("/ColorSpace")
+    colorspace = colorspace.get_object() if colorspace is not None else None
+    if isinstance(colorspace, ArrayObject) and colorspace and colorspace[0] == "/ICCBased":
+        mode = {1: "L", 3: "RGB", 4: "CMYK"}.get(colorspace[1].get_object().get("/N"))
+    else:
+        mode = PDF_IMAGE_MODES.get(colorspace)
+    if mode is None:
+        return None
+    size = (int(image["/Width"]), int(image["/Height"]))
+    if image_filter == "/DCTDecode" and mode != "CMYK":
+        picture = Image.open(BytesIO(image._data))
+        return picture if picture.mode == mode and picture.size == size else None
+    if image_filter in (None, "/FlateDecode"):
+        return Image.frombytes(mode, size, image.get_data())
+    return None
+
+
+def encode_pdf_image(image: StreamObject, picture: Image.Image, quality: int) -> EncodedStreamObject:
+    stream = EncodedStreamObject()
+    for key, value in image.items():
+        if key not in {"/Length", "/Filter", "/DecodeParms", "/Width", "/Height"}:
+            stream[key] = value
+    stream[NameObject("/Width")] = NumberObject(picture.width)
+    stream[NameObject("/Height")] = NumberObject(picture.height)
+    if quality and picture.mode in {"L", "RGB"}:
+        buffer = BytesIO()
+        picture.save(buffer, "JPEG", quality=quality, optimize=True)
+        stream[NameObject("/Filter")] = NameObject("/DCTDecode")
+        stream._data = buffer.getvalue()
+    else:
+        stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+        stream._data = zlib.compress(picture.tobytes(), 9)
+    return stream
+
+
+def optimize_pdf_images(
+    writer: PyPDF2.PdfWriter,
+    page: PyPDF2.PageObject,
+    target_dpi: int,
+    quality: int,
+    report: Dict[str, Any],
+) -> None:
+    placements = image_placements(writer, page.get_contents(), page.get("/Resources"), [1, 0, 0, 1, 0, 0], {})
+    for idnum, (width_pt, height_pt) in placements.items():
+        image = writer.get_object(idnum)
+        picture = decode_pdf_image(image)
+        if picture is None:
+            continue
+        scale = 1.0
+        if target_dpi and width_pt and height_pt:
+            scale = min(
+                1.0,
+                max(width_pt / 72 * target_dpi / picture.width, height_pt / 72 * target_dpi / picture.height),
+            )
+        masks = []
+        mask_ref = image.get("/SMask")
+        if isinstance(mask_ref, IndirectObject):
+            mask_picture = decode_pdf_image(mask_ref.get_object())
+            if mask_picture is None or mask_picture.size != picture.size:
+                scale = 1.0
+            else:
+                masks.append((mask_ref.idnum, mask_picture))
+        if scale < 0.95:
+            size = (max(1, round(picture.width * scale)), max(1, round(picture.height * scale)))
+            for mask_idnum, mask_picture in masks:
+                writer._objects[mask_idnum - 1] = encode_pdf_image(
+                    writer.get_object(mask_idnum), mask_picture.resize(size, Image.LANCZOS), 0
+                )
+            writer._objects[idnum - 1] = encode_pdf_image(image, picture.resize(size, Image.LANCZOS), quality)
+            report["downsampled"] += 1
+        elif quality:
+            encoded = encode_pdf_image(image, picture, quality)
+            if len(encoded._data) < len(image._data):
+                writer._objects[idnum - 1] = encoded
+                report["reencoded"] += 1
+
+
+def compress_pdf_streams(writer: PyPDF2.PdfWriter, report: Dict[str, Any]) -> None:
+    for index, obj in enumerate(writer._objects):
+        if not isinstance(obj, StreamObject):
+            continue
+        stream_filter = obj.get("/Filter")
+        if stream_filter is None:
+            data = obj._data
+        elif stream_filter == "/FlateDecode" and "/DecodeParms" not in obj:
+            data = obj.get_data()
+        else:
+            continue
+        compressed = zlib.compress(data, 9)
+        if len(compressed) >= len(obj._data):
+            continue
+        stream = EncodedStreamObject()
+        for key, value in obj.items():
+            if key != "/Length":
+                stream[key] = value
+        stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+        stream._data = compressed
+        writer._objects[index] = stream
+        report["recompressed"] += 1
+
+
+def replace_references(obj: Any, duplicates: Dict[int, IndirectObject]) -> Any:
+    if isinstance(obj, IndirectObject):
+        return duplicates.get(obj.idnum, obj)
+    if isinstance(obj, DictionaryObject):
+        for key, value in list(obj.items()):
+            obj[key] = replace_references(value, duplicates)
+    elif isinstance(obj, ArrayObject):
+        for index, value in enumerate(obj):
+            obj[index] = replace_references(value, duplicates)
+    return obj
+
+
+def dedupe_pdf_streams(writer: PyPDF2.PdfWriter, report: Dict[str, Any]) -> None:
+    seen: Dict[str, IndirectObject] = {}
+    duplicates: Dict[int, IndirectObject] = {}
+    for index, obj in enumerate(writer._objects):
+        if not isinstance(obj, StreamObject):
+            continue
+        digest = hashlib.sha256(obj._data)
+        for key in sorted(obj):
+            if key != "/Length":
+                digest.update(f"{key}={obj[key]!r}".encode("utf-8"))
+        stream_key = digest.hexdigest()
+        if stream_key in seen:
+            duplicates[index + 1] = seen[stream_key]
+        else:
+            seen[stream_key] = IndirectObject(index + 1, 0, writer)
+    if not duplicates:
+        return
+    for index, obj in enumerate(writer._objects):
+        if index + 1 in duplicates:
+            writer._objects[index] = NullObject()
+        elif obj is not None:
+            replace_references(obj, duplicates)
+    report["deduplicated"] += len(duplicates)
+
+
+def optimize_pdf_template(data: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    report: Dict[str, Any] = {
+        "original_bytes": len(data),
+        "baseline_bytes": len(data),
+        "optimized_bytes": len(data),
+        "recompressed": 0,
+        "deduplicated": 0,
+        "downsampled": 0,
+        "reencoded": 0,
+    }
+    reader = PyPDF2.PdfReader(BytesIO(data))
+    baseline = PyPDF2.PdfWriter()
+    baseline.add_page(reader.pages[0])
+    output_stream = BytesIO()
+    baseline.write(output_stream)
+    report["baseline_bytes"] = output_stream.tell()
+
+    writer = PyPDF2.PdfWriter()
+    page = writer.add_page(reader.pages[0])
+    target_dpi = get_pdf_image_dpi()
+    quality = get_pdf_image_quality()
+    if target_dpi or quality:
+        optimize_pdf_images(writer, page, target_dpi, quality, report)
+    compress_pdf_streams(writer, report)
+    dedupe_pdf_streams(writer, report)
+
+    output_stream = BytesIO()
+    writer.write(output_stream)
+    optimized = output_stream.getvalue()
+    if len(optimized) >= report["baseline_bytes"]:
+        report["optimized_bytes"] = report["baseline_bytes"]
+        return data, report
+    report["optimized_bytes"] = len(optimized)
+    return optimized, report
+
+
+def load_pdf_template(pdf_template_path: Path) -> PyPDF2.PdfReader:
+    key = f"{file_content_hash(pdf_template_path)}:{get_pdf_optimize_key()}"
+    with TEMPLATE_CACHE_LOCK:
+        cached = TEMPLATE_CACHE.get(key)
+        if cached is not None:
+            TEMPLATE_CACHE.move_to_end(key)
+            return cached[0]
+
+        data = pdf_template_path.read_bytes()
+        report: Dict[str, Any] = {"original_bytes": len(data), "baseline_bytes": len(data), "optimized_bytes": len(data)}
+        if pdf_optimize_enabled():
+            try:
+                data, report = optimize_pdf_template(data)
+            except Exception as exc:  # noqa: BLE001
+                report["error"] = str(exc)
+        reader = PyPDF2.PdfReader(BytesIO(data))
+        TEMPLATE_CACHE[key] = (reader, len(data))
+        PDF_OPTIMIZE_REPORTS[key] = report
+
+        limit = get_template_cache_limit()
+        total = sum(size for _, size in TEMPLATE_CACHE.values())
+        while total > limit and len(TEMPLATE_CACHE) > 1:
+            evicted, (_, size) = TEMPLATE_CACHE.popitem(last=False)
+            PDF_OPTIMIZE_REPORTS.pop(evicted, None)
+            total -= size
+        return reader
+
+
+def pdf_template_report(pdf_template_path: Path) -> Dict[str, Any]:
+    load_pdf_template(pdf_template_path)
+    key = f"{file_content_hash(pdf_template_path)}:{get_pdf_optimize_key()}"
+    with TEMPLATE_CACHE_LOCK:
+        return dict(PDF_OPTIMIZE_REPORTS.get(key, {}))
+
+
+def new_pdf_output_report(pdf_template_path: Optional[Path]) -> Optional[Dict[str, Any]]:
+    if not pdf_template_path:
+        return None
+    try:
+        template = pdf_template_report(pdf_template_path)
+    except Exception:  # noqa: BLE001
+        return None
+    return {
+        "optimized": pdf_optimize_enabled() and "error" not in template,
+        "template_bytes": template.get("baseline_bytes", 0),
+        "optimized_template_bytes": template.get("optimized_bytes", 0),
+        "diplomas": 0,
+        "pdf_bytes": 0,
+        "estimated_bytes_saved": 0,
+    }
+
+
+def count_pdf_output(report: Optional[Dict[str, Any]], pdf_attachment: Optional[Attachment]) -> None:
+    if report is None or not pdf_attachment:
+        return
+    report["diplomas"] += 1
+    report["pdf_bytes"] += len(pdf_attachment[1])
+    report["estimated_bytes_saved"] += report["template_bytes"] - report["optimized_template_bytes"]
+
+
+def load_image_template(jpg_template_path: Path) -> Image.Image:
+    key = (file_content_hash(jpg_template_path), jpg_template_path.stat().st_size)
+    with IMAGE_CACHE_LOCK:
+        cached = IMAGE_CACHE.get(key)
+        if cached is not None:
+            IMAGE_CACHE.move_to_end(key)
+            return cached
+
+    with Image.open(jpg_template_path) as source:
+        image = source.convert("RGB")
+    with IMAGE_CACHE_LOCK:
+        IMAGE_CACHE[key] = image
+        limit = get_template_cache_limit()
+        total = sum(len(cached.getbands()) * cached.width * cached.height for cached in IMAGE_CACHE.values())
+        while total > limit and len(IMAGE_CACHE) > 1:
+            _, evicted = IMAGE_CACHE.popitem(last=False)
+            total -= len(evicted.getbands()) * evicted.width * evicted.height
+    return image
+
+
+@functools.lru_cache(maxsize=32)
+def load_truetype_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font_path, font_size)
+
+
+def diploma_filename(student_name: str, suffix: str) -> str:
+    return f"{student_name.replace(' ', '_')}_diploma{suffix}"
+
+
+@timed_stage("diploma_pdf")
+def render_diploma_pdf(pdf_template_path: Path, overlay_page: PyPDF2.PageObject) -> bytes:
+    template_pdf = load_pdf_template(pdf_template_path)
+
+    output = PyPDF2.PdfWriter()
+    with TEMPLATE_CACHE_LOCK:
+        template_page = template_pdf.pages[0]
+        existing_page = PyPDF2.PageObject(template_pdf, template_page.indirect_reference)
+        existing_page.update(template_page)
+        existing_page.merge_page(overlay_page)
+        if pdf_optimize_enabled():
+            existing_page.compress_content_streams()
+        output.add_page(existing_page)
+
+    output_stream = BytesIO()
+    output.write(output_stream)
+    return output_stream.getvalue()
+
+
+def merge_overlay_page(
+    pdf_template_path: Path,
+    overlay_page: PyPDF2.PageObject,
+    student_name: str,
+    output_dir: Path,
+) -> Path:
+    pdf_data = render_diploma_pdf(pdf_template_path, overlay_page)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    pdf_filename = output_dir / diploma_filename(student_name, ".pdf")
+    pdf_filename.write_bytes(pdf_data)
+    return pdf_filename
+
+
 def generate_diploma_pdf(
     pdf_template_path: Path,
     student_name: str,
@@ -147,44 +994,143 @@ def generate_diploma_pdf(
     name_y_offset: int = 0,
 ) -> Path:
     overlay_packet = make_overlay_pdf(student_name, x_offset=name_x_offset, y_offset=name_y_offset)
-    template_pdf = PyPDF2.PdfReader(open(pdf_template_path, "rb"))
-    existing_page = template_pdf.pages[0]
-
     new_pdf = PyPDF2.PdfReader(overlay_packet)
-    overlay_page = new_pdf.pages[0]
-    existing_page.merge_page(overlay_page)
+    return merge_overlay_page(pdf_template_path, new_pdf.pages[0], student_name, output_dir)
 
-    output = PyPDF2.PdfWriter()
-    output.add_page(existing_page)
-
-    output_dir.mkdir(parents=True, exist_ok=True)
-    pdf_filename = output_dir / f"{student_name.replace(' ', '_')}_diploma.pdf"
-    with open(pdf_filename, "wb") as output_stream:
-        output.write(output_stream)
 
-    return pdf_filename
+def generate_diploma_pdfs(
+    pdf_template_path: Path,
+    student_names: List[str],
+    output_dir: Path,
+    name_x_offset: int = 0,
+    name_y_offset: int = 0,
+) -> List[Path]:
+    overlay_pages = render_overlay_pages(student_names, x_offset=name_x_offset, y_offset=name_y_offset)
+    return [
+        merge_overlay_page(pdf_template_path, overlay_page, student_name, output_dir)
+        for student_name, overlay_page in zip(student_names, overlay_pages)
+    ]
 
 
-def convert_pdf_to_jpg(pdf_filename: Path) -> Optional[Path]:
+def pdf_jpg_copy_enabled() -> bool:
     if os.environ.get(DISABLE_JPG_ENV, "1").strip() in {"1", "true", "yes"}:
+        return False
+    return get_convert_from_path() is not None
+
+
+@functools.lru_cache(maxsize=1)
+def get_convert_from_path() -> Any:
+    try:
+        from pdf2image import convert_from_path
+    except Exception:  # noqa: BLE001
         return None
+    return convert_from_path
+
+
+def get_raster_dpi() -> int:
+    try:
+        return max(36, int(os.environ.get(RASTER_DPI_ENV, "").strip() or RASTER_DPI_DEFAULT))
+    except ValueError:
+        return RASTER_DPI_DEFAULT
+
+
+def get_raster_threads() -> int:
+    try:
+        return max(1, int(os.environ.get(RASTER_THREADS_ENV, "").strip() or 1))
+    except ValueError:
+        return 1
+
+
+def rasterize_first_page(pdf_path: Path, dpi: int) -> Image.Image:
+    convert_from_path = get_convert_from_path()
     if convert_from_path is None:
-        return None
-    images = convert_from_path(str(pdf_filename))
-    jpg_filename = pdf_filename.with_suffix(".jpg")
-    images[0].save(jpg_filename, "JPEG")
-    return jpg_filename
+        raise RuntimeError("pdf2image is not installed.")
+    images = convert_from_path(
+        str(pdf_path),
+        dpi=dpi,
+        first_page=1,
+        last_page=1,
+        thread_count=get_raster_threads(),
+    )
+    return images[0].convert("RGB")
+
+
+def load_raster_template(pdf_template_path: Path) -> Tuple[Image.Image, Tuple[float, float, float, float]]:
+    dpi = get_raster_dpi()
+    key = (f"{file_content_hash(pdf_template_path)}:raster", dpi)
+    with IMAGE_CACHE_LOCK:
+        cached = IMAGE_CACHE.get(key)
+        if cached is not None:
+            IMAGE_CACHE.move_to_end(key)
+    if cached is None:
+        cached = rasterize_first_page(pdf_template_path, dpi)
+        with IMAGE_CACHE_LOCK:
+            IMAGE_CACHE[key] = cached
+            limit = get_template_cache_limit()
+            total = sum(len(image.getbands()) * image.width * image.height for image in IMAGE_CACHE.values())
+            while total > limit and len(IMAGE_CACHE) > 1:
+                _, evicted = IMAGE_CACHE.popitem(last=False)
+                total -= len(evicted.getbands()) * evicted.width * evicted.height
+
+    template_pdf = load_pdf_template(pdf_template_path)
+    with TEMPLATE_CACHE_LOCK:
+        box = template_pdf.pages[0].mediabox
+        bounds = (float(box.left), float(box.bottom), float(box.right), float(box.top))
+    return cached, bounds
+
+
+@timed_stage("diploma_jpg")
+def render_pdf_jpg_copy(
+    pdf_template_path: Path,
+    student_name: str,
+    name_x_offset: int = 0,
+    name_y_offset: int = 0,
+) -> bytes:
+    template, (left, _, right, top) = load_raster_template(pdf_template_path)
+    image = template.copy()
+    draw = ImageDraw.Draw(image)
 
+    scale = image.width / (right - left)
+    x = (letter[0] / 2.0 + name_x_offset - left) * scale
+    y = (top - (letter[1] - 220 + name_y_offset)) * scale
 
-def generate_diploma_jpg(
-    jpg_template_path: Path,
+    display_name = student_name
+    if is_hebrew(student_name) and not features.check("raqm"):
+        display_name = student_name[::-1]
+    font_path = get_active_font_path()
+    if font_path and font_path.exists():
+        font = load_truetype_font(str(font_path), max(10, int(42 * scale)))
+    else:
+        font = ImageFont.load_default()
+    draw.text((x, y), display_name, fill=(0, 0, 0), font=font, anchor="ms")
+
+    output_stream = BytesIO()
+    image.save(output_stream, "JPEG", quality=95)
+    return output_stream.getvalue()
+
+
+def generate_diploma_jpg_copy(
+    pdf_template_path: Path,
     student_name: str,
     output_dir: Path,
     name_x_offset: int = 0,
     name_y_offset: int = 0,
 ) -> Path:
+    jpg_data = render_pdf_jpg_copy(pdf_template_path, student_name, name_x_offset, name_y_offset)
     output_dir.mkdir(parents=True, exist_ok=True)
-    image = Image.open(jpg_template_path).convert("RGB")
+    jpg_filename = output_dir / diploma_filename(student_name, ".jpg")
+    jpg_filename.write_bytes(jpg_data)
+    return jpg_filename
+
+
+@timed_stage("diploma_jpg")
+def render_diploma_jpg(
+    jpg_template_path: Path,
+    student_name: str,
+    name_x_offset: int = 0,
+    name_y_offset: int = 0,
+) -> bytes:
+    image = load_image_template(jpg_template_path).copy()
     draw = ImageDraw.Draw(image)
 
     width, height = image.size
@@ -200,7 +1146,7 @@ def generate_diploma_jpg(
     font_size = max(10, int(42 * scale_y))
     font_path = get_active_font_path()
     if font_path and font_path.exists():
-        font = ImageFont.truetype(str(font_path), font_size)
+        font = load_truetype_font(str(font_path), font_size)
     else:
         font = ImageFont.load_default()
 
@@ -209,8 +1155,22 @@ def generate_diploma_jpg(
     text_height = bbox[3] - bbox[1]
     draw.text((absolute_x - text_width / 2, absolute_y - text_height / 2), display_name, fill=(0, 0, 0), font=font)
 
-    jpg_filename = output_dir / f"{student_name.replace(' ', '_')}_diploma.jpg"
-    image.save(jpg_filename, "JPEG", quality=95)
+    output_stream = BytesIO()
+    image.save(output_stream, "JPEG", quality=95)
+    return output_stream.getvalue()
+
+
+def generate_diploma_jpg(
+    jpg_template_path: Path,
+    student_name: str,
+    output_dir: Path,
+    name_x_offset: int = 0,
+    name_y_offset: int = 0,
+) -> Path:
+    jpg_data = render_diploma_jpg(jpg_template_path, student_name, name_x_offset, name_y_offset)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    jpg_filename = output_dir / diploma_filename(student_name, ".jpg")
+    jpg_filename.write_bytes(jpg_data)
     return jpg_filename
 
 
@@ -224,6 +1184,8 @@ def build_message(
     jpg_filename: Optional[Path],
     logo_bytes: Optional[bytes] = None,
     logo_filename: Optional[str] = None,
+    pdf_attachment: Optional[Attachment] = None,
+    jpg_attachment: Optional[Attachment] = None,
 ) -> MIMEMultipart:
     msg = MIMEMultipart("mixed")
     msg["Subject"] = subject or DEFAULT_SUBJECT
@@ -241,23 +1203,125 @@ def build_message(
         image.add_header("Content-ID", "<logo_cid>")
         msg.attach(image)
 
-    if pdf_filename and pdf_filename.exists():
-        with open(pdf_filename, "rb") as f:
-            pdf_data = f.read()
-            pdf_attachment = MIMEApplication(pdf_data, _subtype="pdf")
-            pdf_attachment.add_header("Content-Disposition", "attachment", filename=pdf_filename.name)
-            msg.attach(pdf_attachment)
+    if pdf_attachment is None and pdf_filename and pdf_filename.exists():
+        pdf_attachment = (pdf_filename.name, pdf_filename.read_bytes())
+    if pdf_attachment:
+        pdf_part = MIMEApplication(pdf_attachment[1], _subtype="pdf")
+        pdf_part.add_header("Content-Disposition", "attachment", filename=pdf_attachment[0])
+        msg.attach(pdf_part)
 
-    if jpg_filename and jpg_filename.exists():
-        with open(jpg_filename, "rb") as f:
-            jpg_data = f.read()
-            jpg_attachment = MIMEApplication(jpg_data, _subtype="jpeg")
-            jpg_attachment.add_header("Content-Disposition", "attachment", filename=jpg_filename.name)
-            msg.attach(jpg_attachment)
+    if jpg_attachment is None and jpg_filename and jpg_filename.exists():
+        jpg_attachment = (jpg_filename.name, jpg_filename.read_bytes())
+    if jpg_attachment:
+        jpg_part = MIMEApplication(jpg_attachment[1], _subtype="jpeg")
+        jpg_part.add_header("Content-Disposition", "attachment", filename=jpg_attachment[0])
+        msg.attach(jpg_part)
 
     return msg
 
 
+def compiled_messages_enabled() -> bool:
+    return os.environ.get(COMPILED_MESSAGES_ENV, "1").strip().lower() not in {"0", "false", "no"}
+
+
+def attachment_part(attachment: Attachment, subtype: str) -> bytes:
+    part = MIMEApplication(b"", _subtype=subtype)
+    part.add_header("Content-Disposition", "attachment", filename=attachment[0])
+    return part.as_bytes().split(b"\n\n", 1)[0] + b"\n\n" + base64.encodebytes(attachment[1])
+
+
+class MessageTemplate:
+    def __init__(
+        self,
+        html_content: str,
+        subject: str,
+        from_email: str,
+        logo_bytes: Optional[bytes] = None,
+        logo_filename: Optional[str] = None,
+        compiled: Optional[bool] = None,
+    ) -> None:
+        self.html_content = html_content
+        self.subject = subject or DEFAULT_SUBJECT
+        self.from_email = from_email
+        self.logo_bytes = logo_bytes
+        self.logo_filename = logo_filename
+        self.compiled = compiled_messages_enabled() if compiled is None else compiled
+        if not self.compiled:
+            return
+
+        self.html_parts = html_content.split("{{name}}")
+        self.boundary = f"=============={uuid.uuid4().hex}=="
+        skeleton = MIMEMultipart("mixed", boundary=self.boundary)
+        skeleton["Subject"] = self.subject
+        if from_email:
+            skeleton["From"] = from_email
+        self.headers = skeleton.as_bytes().split(b"\n\n", 1)[0] + b"\n"
+        self.separator = f"\n--{self.boundary}\n".encode("ascii")
+        self.closing = f"\n--{self.boundary}--\n".encode("ascii")
+        self.logo_part = None
+        if logo_bytes:
+            image = MIMEImage(logo_bytes, name=logo_filename or "logo")
+            image.add_header("Content-ID", "<logo_cid>")
+            self.logo_part = image.as_bytes()
+
+    def render(
+        self,
+        student_name: str,
+        student_email: str,
+        pdf_attachment: Optional[Attachment] = None,
+        jpg_attachment: Optional[Attachment] = None,
+    ) -> bytes:
+        started = time.perf_counter()
+        if self.compiled:
+            raw = self.render_compiled(student_name, student_email, pdf_attachment, jpg_attachment)
+        else:
+            raw = build_message(
+                student_name=student_name,
+                student_email=student_email,
+                html_content=self.html_content,
+                subject=self.subject,
+                from_email=self.from_email,
+                pdf_filename=None,
+                jpg_filename=None,
+                logo_bytes=self.logo_bytes,
+                logo_filename=self.logo_filename,
+                pdf_attachment=pdf_attachment,
+                jpg_attachment=jpg_attachment,
+            ).as_bytes()
+        elapsed = time.perf_counter() - started
+        observe_stage("build_message", elapsed)
+        with GMAIL_SERVICES_LOCK:
+            MESSAGE_STATS["messages"] += 1
+            MESSAGE_STATS["message_seconds"] += elapsed
+            MESSAGE_STATS["message_bytes"] += len(raw)
+        return raw
+
+    def render_compiled(
+        self,
+        student_name: str,
+        student_email: str,
+        pdf_attachment: Optional[Attachment],
+        jpg_attachment: Optional[Attachment],
+    ) -> bytes:
+        if "\n" in student_email or "\r" in student_email:
+            raise ValueError("Invalid recipient address")
+        if student_email.isascii():
+            to_header = f"To: {student_email}\n".encode("ascii")
+        else:
+            to_header = f"To: {Header(student_email, 'utf-8').encode()}\n".encode("ascii")
+
+        alt = MIMEMultipart("alternative")
+        alt.attach(MIMEText(student_name.join(self.html_parts), "html", "utf-8"))
+        parts = [alt.as_bytes()]
+        if self.logo_part:
+            parts.append(self.logo_part)
+        if pdf_attachment:
+            parts.append(attachment_part(pdf_attachment, "pdf"))
+        if jpg_attachment:
+            parts.append(attachment_part(jpg_attachment, "jpeg"))
+        return b"".join([self.headers, to_header, self.separator, self.separator.join(parts), self.closing])
+
+
 def build_text_message(subject: str, body: str, from_email: str, to_email: str) -> MIMEMultipart:
     msg = MIMEMultipart("alternative")
     msg["Subject"] = subject
@@ -275,22 +1339,376 @@ def send_batch_notification(credentials: Credentials, from_email: str, total_sen
     send_email_gmail(msg, credentials)
 
 
-def save_credentials(credentials: Credentials) -> None:
+def send_diploma_group(
+    entries: List[Tuple[Dict[str, str], Optional[Attachment], Optional[Attachment], Optional[str]]],
+    credentials: Credentials,
+    template: MessageTemplate,
+    scheduler: Optional[SendScheduler] = None,
+    campaign: Optional[str] = None,
+) -> List[Optional[str]]:
+    outcomes: List[Optional[str]] = [None] * len(entries)
+    messages = []
+    positions = []
+    for position, (student, pdf_attachment, jpg_attachment, render_error) in enumerate(entries):
+        if render_error:
+            outcomes[position] = render_error
+            continue
+        try:
+            messages.append(template.render(student["name"], student["email"], pdf_attachment, jpg_attachment))
+            positions.append(position)
+        except Exception as exc:  # noqa: BLE001
+            outcomes[position] = str(exc)
+
+    if messages:
+        if scheduler is None:
+            try:
+                results = [str(exc) if exc else None for exc in send_email_gmail_batch(messages, credentials)]
+            except Exception as exc:  # noqa: BLE001
+                results = [str(exc)] * len(messages)
+        else:
+            results = send_with_retries(messages, credentials, scheduler)
+        for position, error in zip(positions, results):
+            outcomes[position] = error
+            if error is None:
+                _, pdf_attachment, jpg_attachment, _ = entries[position]
+                increment_metric("messages_sent")
+                increment_metric(
+                    "attachment_bytes",
+                    sum(len(attachment[1]) for attachment in (pdf_attachment, jpg_attachment) if attachment),
+                )
+        if campaign:
+            delivered = [
+                ledger_email(entries[position][0]["email"]) for position, error in zip(positions, results) if error is None
+            ]
+            try:
+                record_sent(campaign, delivered)
+            except sqlite3.Error:
+                pass
+    increment_metric("send_errors", sum(1 for error in outcomes if error is not None))
+    return outcomes
+
+
+def group_rendered(
+    rendered: Iterator[Tuple[int, Dict[str, str], Optional[Attachment], Optional[Attachment], Optional[str]]],
+    group_size: int,
+) -> Iterator[List[Tuple[int, Dict[str, str], Optional[Attachment], Optional[Attachment], Optional[str]]]]:
+    group = []
+    for item in rendered:
+        group.append(item)
+        if len(group) >= group_size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+class SendScheduler:
+    def __init__(self, rate: float, max_rate: float, max_retries: int) -> None:
+        self.rate = max(SEND_RATE_MIN, min(rate, max_rate))
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.tokens = max(1.0, self.rate)
+        self.updated = time.monotonic()
+        self.last_throttle = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def acquire(self, count: int = 1) -> None:
+        while True:
+            if self.cancelled.is_set():
+                raise RuntimeError("Send cancelled: the client disconnected.")
+            with self.lock:
+                now = time.monotonic()
+                capacity = max(1.0, self.rate)
+                self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                needed = min(float(count), capacity)
+                if self.tokens >= needed:
+                    self.tokens -= count
+                    return
+                wait = (needed - self.tokens) / self.rate
+            self.cancelled.wait(wait)
+
+    def record_success(self, count: int = 1) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + SEND_RATE_STEP * count)
+
+    def record_retry(self, count: int, throttled: bool) -> None:
+        with self.lock:
+            self.retries += count
+            if not throttled:
+                return
+            self.throttled += count
+            now = time.monotonic()
+            if now - self.last_throttle >= 1.0:
+                self.rate = max(SEND_RATE_MIN, self.rate / 2)
+                self.tokens = min(self.tokens, 0.0)
+                self.last_throttle = now
+
+    def backoff(self, attempt: int) -> float:
+        return min(SEND_BACKOFF_CAP, SEND_BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"rate": round(self.rate, 2), "retries": self.retries, "throttled": self.throttled}
+
+
+def create_send_scheduler() -> SendScheduler:
+    def read_env(name: str, default: float) -> float:
+        value = os.environ.get(name, "").strip()
+        try:
+            return float(value) if value else default
+        except ValueError:
+            return default
+
+    max_rate = max(SEND_RATE_MIN, read_env(SEND_RATE_MAX_ENV, SEND_RATE_MAX_DEFAULT))
+    return SendScheduler(
+        rate=read_env(SEND_RATE_ENV, SEND_RATE_DEFAULT),
+        max_rate=max_rate,
+        max_retries=max(0, int(read_env(SEND_MAX_RETRIES_ENV, SEND_MAX_RETRIES_DEFAULT))),
+    )
+
+
+def is_throttle_error(exc: Exception) -> bool:
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(exc, HttpError):
+        return False
+    if exc.resp.status == 429:
+        return True
+    content = exc.content.decode("utf-8", errors="replace").lower()
+    return exc.resp.status == 403 and any(reason in content for reason in THROTTLE_REASONS)
+
+
+def is_transient_error(exc: Exception) -> bool:
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    if isinstance(exc, HttpError):
+        return exc.resp.status in TRANSIENT_HTTP_STATUSES or is_throttle_error(exc)
+    return isinstance(exc, (OSError, httplib2.HttpLib2Error))
+
+
+def send_with_retries(
+    messages: List[bytes],
+    credentials: Credentials,
+    scheduler: SendScheduler,
+) -> List[Optional[str]]:
+    outcomes: List[Optional[str]] = [None] * len(messages)
+    remaining = list(range(len(messages)))
+    attempt = 0
+    while remaining:
+        scheduler.acquire(len(remaining))
+        try:
+            results = send_email_gmail_batch([messages[position] for position in remaining], credentials)
+        except Exception as exc:  # noqa: BLE001
+            results = [exc] * len(remaining)
+
+        retry = []
+        throttled = False
+        for position, exc in zip(remaining, results):
+            if exc is None:
+                outcomes[position] = None
+            elif attempt < scheduler.max_retries and is_transient_error(exc):
+                retry.append(position)
+                throttled = throttled or is_throttle_error(exc)
+            else:
+                outcomes[position] = str(exc)
+
+        succeeded = sum(1 for exc in results if exc is None)
+        if succeeded:
+            scheduler.record_success(succeeded)
+        if retry:
+            attempt += 1
+            increment_metric("send_retries", len(retry))
+            scheduler.record_retry(len(retry), throttled)
+            scheduler.cancelled.wait(scheduler.backoff(attempt))
+        remaining = retry
+    return outcomes
+
+
+def get_send_concurrency() -> int:
+    value = os.environ.get(SEND_CONCURRENCY_ENV, "").strip()
+    try:
+        return max(1, int(value)) if value else SEND_CONCURRENCY_DEFAULT
+    except ValueError:
+        return SEND_CONCURRENCY_DEFAULT
+
+
+def get_gmail_batch_size() -> int:
+    value = os.environ.get(GMAIL_BATCH_SIZE_ENV, "").strip()
+    try:
+        size = int(value) if value else 1
+    except ValueError:
+        size = 1
+    return max(1, min(GMAIL_BATCH_LIMIT, size))
+
+
+@contextmanager
+def token_file_lock() -> Iterator[None]:
     TOKEN_DIR.mkdir(parents=True, exist_ok=True)
-    TOKEN_FILE.write_text(credentials.to_json(), encoding="utf-8")
+    with open(TOKEN_LOCK_FILE, "a+b") as handle:
+        if os.name == "nt":
+            import msvcrt
 
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
 
-def load_credentials() -> Credentials | None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def write_token_file(credentials: Credentials) -> None:
+    tmp_path = TOKEN_DIR / f"{TOKEN_FILE.name}.{uuid.uuid4().hex}.tmp"
+    tmp_path.write_text(credentials.to_json(), encoding="utf-8")
+    os.replace(tmp_path, TOKEN_FILE)
+
+
+def save_credentials(credentials: Credentials) -> None:
+    with token_file_lock():
+        write_token_file(credentials)
+    invalidate_gmail_services()
+    cache_credentials(credentials)
+
+
+def delete_credentials() -> None:
+    with token_file_lock():
+        if TOKEN_FILE.exists():
+            TOKEN_FILE.unlink()
+    invalidate_gmail_services()
+    cache_credentials(None)
+
+
+def seconds_until_expiry(credentials: Credentials) -> Optional[float]:
+    if credentials.expiry is None:
+        return None
+    return (credentials.expiry - datetime.utcnow()).total_seconds()
+
+
+def refresh_credentials(margin: float = 0.0) -> Credentials | None:
+    from google.auth.transport.requests import Request as GoogleRequest
+    from google.oauth2.credentials import Credentials
+
+    with token_file_lock():
+        if not TOKEN_FILE.exists():
+            return None
+        credentials = Credentials.from_authorized_user_file(str(TOKEN_FILE), SCOPES)
+        remaining = seconds_until_expiry(credentials)
+        if credentials.refresh_token and (credentials.expired or remaining is not None and remaining < margin):
+            credentials.refresh(GoogleRequest())
+            write_token_file(credentials)
+    invalidate_gmail_services()
+    return credentials
+
+
+def read_credentials() -> Credentials | None:
     if not TOKEN_FILE.exists():
         return None
+    from google.oauth2.credentials import Credentials
+
     credentials = Credentials.from_authorized_user_file(str(TOKEN_FILE), SCOPES)
     if credentials.expired and credentials.refresh_token:
         try:
-            credentials.refresh(GoogleRequest())
-            save_credentials(credentials)
+            credentials = refresh_credentials()
         except Exception:
             return None
-    return credentials if credentials.valid else None
+    return credentials if credentials and credentials.valid else None
+
+
+def credential_cache_enabled() -> bool:
+    return os.environ.get(CREDENTIAL_CACHE_ENV, "1").strip().lower() not in {"0", "false", "no"}
+
+
+def token_file_stamp() -> Optional[Tuple[int, int]]:
+    try:
+        stat = TOKEN_FILE.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def cache_credentials(credentials: Credentials | None) -> None:
+    stamp = token_file_stamp()
+    with CREDENTIAL_LOCK:
+        previous = CREDENTIAL_CACHE["credentials"]
+        if previous is not None and (credentials is None or previous.refresh_token != credentials.refresh_token):
+            SENDER_PROFILES.pop(previous.refresh_token or "", None)
+        CREDENTIAL_CACHE.update(loaded=True, credentials=credentials, stamp=stamp, checked_at=time.monotonic())
+    CREDENTIAL_WAKEUP.set()
+
+
+def load_credentials() -> Credentials | None:
+    if not credential_cache_enabled():
+        return read_credentials()
+
+    now = time.monotonic()
+    with CREDENTIAL_LOCK:
+        credentials = CREDENTIAL_CACHE["credentials"]
+        usable = CREDENTIAL_CACHE["loaded"] and (credentials is None or credentials.valid)
+        if usable and now - CREDENTIAL_CACHE["checked_at"] < CREDENTIAL_RECHECK_SECONDS:
+            CREDENTIAL_STATS["hits"] += 1
+            return credentials
+
+    stamp = token_file_stamp()
+    with CREDENTIAL_LOCK:
+        if usable and stamp == CREDENTIAL_CACHE["stamp"] and (credentials is not None or stamp is None):
+            CREDENTIAL_CACHE["checked_at"] = now
+            CREDENTIAL_STATS["hits"] += 1
+            return credentials
+        CREDENTIAL_STATS["loads"] += 1
+
+    credentials = read_credentials()
+    cache_credentials(credentials)
+    start_credential_refresher()
+    return credentials
+
+
+def run_credential_refresher() -> None:
+    while True:
+        with CREDENTIAL_LOCK:
+            credentials = CREDENTIAL_CACHE["credentials"]
+        remaining = seconds_until_expiry(credentials) if credentials and credentials.refresh_token else None
+        delay = CREDENTIAL_IDLE_SECONDS if remaining is None else remaining - CREDENTIAL_REFRESH_MARGIN_SECONDS
+        if delay > 0:
+            CREDENTIAL_WAKEUP.wait(min(delay, CREDENTIAL_IDLE_SECONDS))
+            CREDENTIAL_WAKEUP.clear()
+            continue
+        try:
+            refreshed = refresh_credentials(CREDENTIAL_REFRESH_MARGIN_SECONDS)
+        except Exception:  # noqa: BLE001
+            CREDENTIAL_WAKEUP.wait(CREDENTIAL_REFRESH_RETRY_SECONDS)
+            CREDENTIAL_WAKEUP.clear()
+            continue
+        with CREDENTIAL_LOCK:
+            CREDENTIAL_STATS["background_refreshes"] += 1
+        cache_credentials(refreshed if refreshed and refreshed.valid else None)
+
+
+def start_credential_refresher() -> None:
+    global CREDENTIAL_REFRESHER
+    if not credential_cache_enabled():
+        return
+    with CREDENTIAL_LOCK:
+        if CREDENTIAL_REFRESHER is not None and CREDENTIAL_REFRESHER.is_alive():
+            return
+        CREDENTIAL_REFRESHER = threading.Thread(
+            target=run_credential_refresher, name="diploma-credential-refresher", daemon=True
+        )
+        CREDENTIAL_REFRESHER.start()
 
 
 def get_client_secret_path() -> Path:
@@ -300,7 +1718,9 @@ def get_client_secret_path() -> Path:
     return CLIENT_SECRETS
 
 
-def get_flow(redirect_uri: str) -> Flow:
+def get_flow(redirect_uri: str) -> Any:
+    from google_auth_oauthlib.flow import Flow
+
     client_secret_path = get_client_secret_path()
     if not client_secret_path.exists():
         raise FileNotFoundError(
@@ -313,19 +1733,130 @@ def get_flow(redirect_uri: str) -> Flow:
     )
 
 
+def gmail_service_cache_enabled() -> bool:
+    return os.environ.get(GMAIL_SERVICE_CACHE_ENV, "1").strip().lower() not in {"0", "false", "no"}
+
+
+def get_gmail_service(credentials: Credentials) -> Any:
+    key = (threading.get_ident(), credentials.token or "")
+    cache_enabled = gmail_service_cache_enabled()
+    if cache_enabled:
+        with GMAIL_SERVICES_LOCK:
+            service = GMAIL_SERVICES.get(key)
+            if service is not None:
+                GMAIL_STATS["reuses"] += 1
+                return service
+
+    service = build_gmail_service(credentials)
+    if cache_enabled:
+        with GMAIL_SERVICES_LOCK:
+            GMAIL_SERVICES[key] = service
+    return service
+
+
+def build_gmail_service(credentials: Credentials) -> Any:
+    from googleapiclient.discovery import build
+
+    started = time.perf_counter()
+    endpoint = os.environ.get(GMAIL_API_ENDPOINT_ENV, "").strip()
+    client_options = {"api_endpoint": endpoint} if endpoint else None
+    service = build("gmail", "v1", credentials=credentials, cache_discovery=False, client_options=client_options)
+    elapsed = time.perf_counter() - started
+    with GMAIL_SERVICES_LOCK:
+        GMAIL_STATS["builds"] += 1
+        GMAIL_STATS["build_seconds"] += elapsed
+    return service
+
+
+def invalidate_gmail_services() -> None:
+    with GMAIL_SERVICES_LOCK:
+        GMAIL_SERVICES.clear()
+
+
 def send_email_gmail(
     message: MIMEMultipart,
     credentials: Credentials,
 ) -> None:
-    service = build("gmail", "v1", credentials=credentials, cache_discovery=False)
-    raw = base64.urlsafe_b64encode(message.as_bytes()).decode("utf-8")
+    send_raw_email_gmail(message.as_bytes(), credentials)
+
+
+def send_raw_email_gmail(
+    message: bytes,
+    credentials: Credentials,
+) -> None:
+    service = get_gmail_service(credentials)
+    started = time.perf_counter()
+    raw = base64.urlsafe_b64encode(message).decode("utf-8")
+    observe_stage("base64", time.perf_counter() - started)
+    started = time.perf_counter()
     service.users().messages().send(userId="me", body={"raw": raw}).execute()
+    elapsed = time.perf_counter() - started
+    observe_stage("gmail_send", elapsed)
+    with GMAIL_SERVICES_LOCK:
+        GMAIL_STATS["sends"] += 1
+        GMAIL_STATS["send_seconds"] += elapsed
+
+
+def send_email_gmail_batch(
+    messages: List[bytes],
+    credentials: Credentials,
+) -> List[Optional[Exception]]:
+    if len(messages) == 1:
+        try:
+            send_raw_email_gmail(messages[0], credentials)
+            return [None]
+        except Exception as exc:  # noqa: BLE001
+            return [exc]
+
+    service = get_gmail_service(credentials)
+    outcomes: List[Optional[Exception]] = [RuntimeError("No response for batched message.")] * len(messages)
+
+    def on_response(request_id: str, response: Any, exception: Optional[Exception]) -> None:
+        outcomes[int(request_id)] = exception
+
+    endpoint = os.environ.get(GMAIL_API_ENDPOINT_ENV, "").strip()
+    if endpoint:
+        from googleapiclient.http import BatchHttpRequest
+
+        batch = BatchHttpRequest(callback=on_response, batch_uri=f"{endpoint.rstrip('/')}/batch/gmail/v1")
+    else:
+        batch = service.new_batch_http_request(callback=on_response)
+    encode_seconds = 0.0
+    for position, message in enumerate(messages):
+        started = time.perf_counter()
+        raw = base64.urlsafe_b64encode(message).decode("utf-8")
+        encode_seconds += time.perf_counter() - started
+        batch.add(service.users().messages().send(userId="me", body={"raw": raw}), request_id=str(position))
+    observe_stage("base64", encode_seconds, len(messages))
+
+    started = time.perf_counter()
+    batch.execute()
+    elapsed = time.perf_counter() - started
+    observe_stage("gmail_send", elapsed, len(messages))
+    with GMAIL_SERVICES_LOCK:
+        GMAIL_STATS["sends"] += len(messages)
+        GMAIL_STATS["send_seconds"] += elapsed
+    return outcomes
 
 
 def get_gmail_address(credentials: Credentials) -> str:
-    service = build("gmail", "v1", credentials=credentials, cache_discovery=False)
+    key = credentials.refresh_token or ""
+    cache_enabled = credential_cache_enabled() and bool(key)
+    if cache_enabled:
+        with CREDENTIAL_LOCK:
+            email = SENDER_PROFILES.get(key)
+            if email:
+                CREDENTIAL_STATS["profile_hits"] += 1
+                return email
+
+    service = get_gmail_service(credentials)
     profile = service.users().getProfile(userId="me").execute()
-    return profile.get("emailAddress", "")
+    email = profile.get("emailAddress", "")
+    with CREDENTIAL_LOCK:
+        CREDENTIAL_STATS["profile_lookups"] += 1
+        if cache_enabled and email:
+            SENDER_PROFILES[key] = email
+    return email
 
 
 def text_to_html(text: str) -> str:
@@ -345,92 +1876,1151 @@ def text_to_html(text: str) -> str:
     )
 
 
-def inject_logo_cid(html_content: str, cid: str = "logo_cid") -> str:
-    if f"cid:{cid}" in html_content:
-        return html_content
-    img_tag = f'<img src="cid:{cid}" style="max-width: 220px; height: auto; display: block; margin-bottom: 12px;" />'
-    match = re.search(r"</body>", html_content, re.IGNORECASE)
-    if match:
-        insert_at = match.start()
-        return html_content[:insert_at] + img_tag + html_content[insert_at:]
-    return html_content + img_tag
+def inject_logo_cid(html_content: str, cid: str = "logo_cid") -> str:
+    if f"cid:{cid}" in html_content:
+        return html_content
+    img_tag = f'<img src="cid:{cid}" style="max-width: 220px; height: auto; display: block; margin-bottom: 12px;" />'
+    match = re.search(r"</body>", html_content, re.IGNORECASE)
+    if match:
+        insert_at = match.start()
+        return html_content[:insert_at] + img_tag + html_content[insert_at:]
+    return html_content + img_tag
+
+
+def detect_csv_encoding(prefix: bytes) -> str:
+    for encoding in ("utf-8-sig", "ascii", "latin-1"):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(prefix, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "utf-8"
+
+
+def open_csv_reader(stream: BinaryIO) -> csv.DictReader:
+    prefix = stream.read(CSV_SNIFF_BYTES)
+    stream.seek(0)
+    text = io.TextIOWrapper(stream, encoding=detect_csv_encoding(prefix), errors="replace", newline="")
+    return csv.DictReader(text)
+
+
+def normalize_student_row(row: Dict[str, str], fieldnames: List[str]) -> Dict[str, str]:
+    name_field = (row.get("name") or "").strip()
+    first = (row.get("first") or "").strip()
+    last = (row.get("last") or "").strip()
+    email = (row.get("email") or "").strip() or (row.get("mail") or "").strip()
+    new = (row.get("new") or "").strip()
+    send = (row.get("send") or "").strip()
+
+    has_name_field = "name" in fieldnames
+    full_name = name_field if has_name_field and name_field else f"{first} {last}".strip()
+
+    return {
+        "first": first,
+        "last": last,
+        "email": email,
+        "new": new,
+        "send": send,
+        "name": full_name,
+    }
+
+
+def iter_csv_students(stream: BinaryIO) -> Iterator[Dict[str, str]]:
+    started = time.perf_counter()
+    elapsed = 0.0
+    parsed = 0
+    try:
+        reader = open_csv_reader(stream)
+        fieldnames = reader.fieldnames or []
+        for row in reader:
+            student = normalize_student_row(row, fieldnames)
+            elapsed += time.perf_counter() - started
+            parsed += 1
+            yield student
+            started = time.perf_counter()
+        elapsed += time.perf_counter() - started
+    finally:
+        observe_stage("csv_parse", elapsed)
+        increment_metric("csv_rows", parsed)
+
+
+def iter_csv_with_headers(stream: BinaryIO) -> Tuple[List[str], Iterator[Dict[str, Any]]]:
+    reader = open_csv_reader(stream)
+    fieldnames = list(reader.fieldnames or [])
+    if "new" not in fieldnames:
+        fieldnames.append("new")
+    if "send" not in fieldnames:
+        fieldnames.append("send")
+
+    def rows() -> Iterator[Dict[str, Any]]:
+        for row in reader:
+            raw = {key: (row.get(key) or "").strip() for key in fieldnames}
+            normalized = normalize_student_row(raw, fieldnames)
+            yield {
+                "raw": raw,
+                "name": normalized["name"],
+                "email": normalized["email"],
+                "new": normalized["new"],
+                "send": normalized["send"],
+            }
+
+    return fieldnames, rows()
+
+
+def parse_csv(content: bytes) -> List[Dict[str, str]]:
+    return list(iter_csv_students(io.BytesIO(content)))
+
+
+def parse_csv_with_headers(content: bytes) -> Tuple[List[str], List[Dict[str, Any]]]:
+    fieldnames, rows = iter_csv_with_headers(io.BytesIO(content))
+    return fieldnames, list(rows)
+
+def parse_selected_indices(selected_indices: str) -> set:
+    selected = set()
+    if selected_indices.strip():
+        for chunk in selected_indices.split(","):
+            chunk = chunk.strip()
+            if chunk.isdigit():
+                selected.add(int(chunk))
+    return selected
+
+
+def get_skip_reason(student: Dict[str, str], idx: int, selected: set) -> Optional[str]:
+    if selected and idx not in selected:
+        return "Not selected"
+    if not student["email"]:
+        return "Missing email"
+    if student["new"] != "1" or student["send"] != "":
+        return "Not eligible or already sent"
+    return None
+
+
+def split_eligible(
+    students: Iterable[Dict[str, str]],
+    selected: set,
+    skipped: List[Tuple[int, Dict[str, str], str]],
+    campaign: Optional[str] = None,
+) -> Iterator[Tuple[int, Dict[str, str]]]:
+    rows = enumerate(students)
+    while True:
+        block = [
+            (idx, student, get_skip_reason(student, idx, selected))
+            for idx, student in itertools.islice(rows, LEDGER_LOOKUP_BATCH)
+        ]
+        if not block:
+            return
+        already_sent = set()
+        if campaign:
+            already_sent = find_sent(campaign, [ledger_email(student["email"]) for _, student, reason in block if not reason])
+        for idx, student, reason in block:
+            if not reason and ledger_email(student["email"]) in already_sent:
+                reason = "Already sent"
+            if reason:
+                increment_metric("rows_skipped")
+                skipped.append((idx, student, reason))
+            else:
+                yield idx, student
+
+
+def get_render_workers() -> int:
+    value = os.environ.get(RENDER_WORKERS_ENV, "").strip().lower()
+    if value == "auto":
+        return os.cpu_count() or 1
+    try:
+        return max(0, int(value)) if value else 0
+    except ValueError:
+        return 0
+
+
+def init_render_worker(pdf_template_path: Optional[Path], jpg_template_path: Optional[Path]) -> None:
+    register_font_once()
+    if pdf_template_path:
+        load_pdf_template(pdf_template_path)
+    if jpg_template_path:
+        load_image_template(jpg_template_path)
+    elif pdf_template_path and pdf_jpg_copy_enabled():
+        load_raster_template(pdf_template_path)
+
+
+def persist_output_enabled() -> bool:
+    return os.environ.get(PERSIST_OUTPUT_ENV, "1").strip().lower() not in {"0", "false", "no"}
+
+
+def render_diploma_chunk(
+    student_names: List[str],
+    pdf_template_path: Optional[Path],
+    jpg_template_path: Optional[Path],
+    output_dir: Optional[Path],
+    name_x_offset: int = 0,
+    name_y_offset: int = 0,
+) -> List[Tuple[Optional[Attachment], Optional[Attachment], Optional[str]]]:
+    overlay_pages: List[Any] = [None] * len(student_names)
+    if pdf_template_path:
+        try:
+            overlay_pages = render_overlay_pages(student_names, x_offset=name_x_offset, y_offset=name_y_offset)
+        except Exception:  # noqa: BLE001
+            pass
+
+    persist = output_dir is not None and persist_output_enabled()
+    jpg_copy = bool(pdf_template_path and not jpg_template_path and pdf_jpg_copy_enabled())
+    results = []
+    for student_name, overlay_page in zip(student_names, overlay_pages):
+        try:
+            pdf_attachment = None
+            if pdf_template_path:
+                if overlay_page is None:
+                    overlay_packet = make_overlay_pdf(student_name, x_offset=name_x_offset, y_offset=name_y_offset)
+                    overlay_page = PyPDF2.PdfReader(overlay_packet).pages[0]
+                pdf_data = render_diploma_pdf(pdf_template_path, overlay_page)
+                pdf_attachment = (diploma_filename(student_name, ".pdf"), pdf_data)
+            jpg_attachment = None
+            if jpg_template_path:
+                jpg_data = render_diploma_jpg(jpg_template_path, student_name, name_x_offset, name_y_offset)
+                jpg_attachment = (diploma_filename(student_name, ".jpg"), jpg_data)
+            elif jpg_copy:
+                jpg_data = render_pdf_jpg_copy(pdf_template_path, student_name, name_x_offset, name_y_offset)
+                jpg_attachment = (diploma_filename(student_name, ".jpg"), jpg_data)
+            if persist:
+                output_dir.mkdir(parents=True, exist_ok=True)
+                for attachment in (pdf_attachment, jpg_attachment):
+                    if attachment:
+                        (output_dir / attachment[0]).write_bytes(attachment[1])
+            results.append((pdf_attachment, jpg_attachment, None))
+        except Exception as exc:  # noqa: BLE001
+            results.append((None, None, str(exc)))
+    return results
+
+
+def render_diploma_chunk_metered(*args: Any) -> Tuple[List[Any], Tuple[Dict[str, List[float]], Dict[str, float]]]:
+    results = render_diploma_chunk(*args)
+    return results, drain_metrics()
+
+
+def merge_chunk_metrics(get_result: Any) -> List[Tuple[Optional[Attachment], Optional[Attachment], Optional[str]]]:
+    results, (stages, counters) = get_result()
+    merge_metrics(stages, counters)
+    return results
+
+
+def render_diplomas(
+    rows: Iterable[Tuple[int, Dict[str, str]]],
+    pdf_template_path: Optional[Path],
+    jpg_template_path: Optional[Path],
+    output_dir: Optional[Path],
+    name_x_offset: int = 0,
+    name_y_offset: int = 0,
+) -> Iterator[Tuple[int, Dict[str, str], Optional[Attachment], Optional[Attachment], Optional[str]]]:
+    rows = iter(rows)
+    workers = get_render_workers()
+    head = list(itertools.islice(rows, RENDER_CHUNK_SIZE * workers))
+    workers = min(workers, len(head))
+    chunk_size = max(1, min(RENDER_CHUNK_SIZE, -(-len(head) // max(workers, 1))))
+    remaining = itertools.chain(head, rows)
+    chunks = iter(lambda: list(itertools.islice(remaining, chunk_size)), [])
+
+    def collect(chunk, render):
+        try:
+            results = render()
+        except Exception as exc:  # noqa: BLE001
+            results = [(None, None, str(exc))] * len(chunk)
+        for (idx, student), (pdf_attachment, jpg_attachment, render_error) in zip(chunk, results):
+            yield idx, student, pdf_attachment, jpg_attachment, render_error
+
+    if workers <= 1:
+        for chunk in chunks:
+            names = [student["name"] for _, student in chunk]
+            yield from collect(chunk, functools.partial(
+                render_diploma_chunk, names, pdf_template_path, jpg_template_path, output_dir, name_x_offset, name_y_offset
+            ))
+        return
+
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_render_worker,
+        initargs=(pdf_template_path, jpg_template_path),
+    )
+    pending = deque()
+    try:
+        for chunk in chunks:
+            names = [student["name"] for _, student in chunk]
+            future = executor.submit(
+                render_diploma_chunk_metered,
+                names,
+                pdf_template_path,
+                jpg_template_path,
+                output_dir,
+                name_x_offset,
+                name_y_offset,
+            )
+            pending.append((chunk, functools.partial(merge_chunk_metrics, future.result)))
+            if len(pending) > workers * 2:
+                yield from collect(*pending.popleft())
+        while pending:
+            yield from collect(*pending.popleft())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ExportBuffer:
+    def __init__(self) -> None:
+        self.parts: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+class MergedPdfWriter:
+    def __init__(self) -> None:
+        self.buffer = ExportBuffer()
+        self.position = 0
+        self.offsets: List[int] = []
+        self.kids: List[int] = []
+        self.queue: List[Tuple[IndirectObject, Any, Dict[int, IndirectObject]]] = []
+        self.pages_ref = self.reserve()
+        self.emit(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def reserve(self) -> IndirectObject:
+        self.offsets.append(0)
+        return IndirectObject(len(self.offsets), 0, None)
+
+    def emit(self, data: bytes) -> None:
+        self.buffer.write(data)
+        self.position += len(data)
+
+    def write_object(self, ref: IndirectObject, obj: Any) -> None:
+        self.offsets[ref.idnum - 1] = self.position
+        stream = BytesIO()
+        stream.write(f"{ref.idnum} 0 obj\n".encode("ascii"))
+        obj.write_to_stream(stream, None)
+        stream.write(b"\nendobj\n")
+        self.emit(stream.getvalue())
+
+    def add_object(self, obj: Any) -> IndirectObject:
+        ref = self.reserve()
+        self.write_object(ref, obj)
+        return ref
+
+    def copy(self, obj: Any, refs: Dict[int, IndirectObject]) -> Any:
+        if isinstance(obj, IndirectObject):
+            ref = refs.get(obj.idnum)
+            if ref is None:
+                ref = refs[obj.idnum] = self.reserve()
+                self.queue.append((ref, obj, refs))
+            return ref
+        if isinstance(obj, StreamObject):
+            stream = EncodedStreamObject() if "/Filter" in obj else StreamObject()
+            for key, value in obj.items():
+                if key != "/Length":
+                    stream[NameObject(key)] = self.copy(value, refs)
+            stream._data = obj._data if "/Filter" in obj else obj.get_data()
+            return stream
+        if isinstance(obj, DictionaryObject):
+            copied = DictionaryObject()
+            for key, value in obj.items():
+                if key != "/Parent":
+                    copied[NameObject(key)] = self.copy(value, refs)
+            return copied
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.copy(value, refs) for value in obj)
+        return obj
+
+    def import_object(self, obj: Any, refs: Dict[int, IndirectObject]) -> Any:
+        copied = self.copy(obj, refs)
+        while self.queue:
+            ref, source, source_refs = self.queue.pop()
+            self.write_object(ref, self.copy(source.get_object(), source_refs))
+        return copied
+
+    def add_form(self, page: PyPDF2.PageObject, refs: Dict[int, IndirectObject]) -> IndirectObject:
+        contents = page.get_contents()
+        form = EncodedStreamObject()
+        form[NameObject("/Type")] = NameObject("/XObject")
+        form[NameObject("/Subtype")] = NameObject("/Form")
+        form[NameObject("/BBox")] = ArrayObject(page.mediabox)
+        form[NameObject("/Resources")] = self.import_object(page.get("/Resources", DictionaryObject()), refs)
+        form[NameObject("/Filter")] = NameObject("/FlateDecode")
+        form._data = zlib.compress(contents.get_data() if contents is not None else b"")
+        return self.add_object(form)
+
+    @contextmanager
+    def rollback_on_error(self, refs: Dict[int, IndirectObject]) -> Iterator[None]:
+        state = (self.position, len(self.buffer.parts), len(self.offsets), len(self.kids), dict(refs))
+        try:
+            yield
+        except Exception:
+            self.position, parts, offsets, kids, saved_refs = state
+            del self.buffer.parts[parts:]
+            del self.offsets[offsets:]
+            del self.kids[kids:]
+            self.queue.clear()
+            refs.clear()
+            refs.update(saved_refs)
+            raise
+
+    def add_page(self, layout: PyPDF2.PageObject, forms: List[IndirectObject]) -> None:
+        content = StreamObject()
+        content._data = b" ".join(f"q /F{index} Do Q".encode("ascii") for index in range(len(forms)))
+        page = DictionaryObject()
+        page[NameObject("/Type")] = NameObject("/Page")
+        page[NameObject("/Parent")] = self.pages_ref
+        page[NameObject("/MediaBox")] = ArrayObject(layout.mediabox)
+        if "/Rotate" in layout:
+            page[NameObject("/Rotate")] = NumberObject(layout["/Rotate"])
+        xobjects = DictionaryObject()
+        for index, form_ref in enumerate(forms):
+            xobjects[NameObject(f"/F{index}")] = form_ref
+        resources = DictionaryObject()
+        resources[NameObject("/XObject")] = xobjects
+        page[NameObject("/Resources")] = resources
+        page[NameObject("/Contents")] = self.add_object(content)
+        self.kids.append(self.add_object(page).idnum)
+
+    def finish(self) -> None:
+        self.offsets[self.pages_ref.idnum - 1] = self.position
+        self.emit(f"{self.pages_ref.idnum} 0 obj\n<<\n/Type /Pages\n/Count {len(self.kids)}\n/Kids [".encode("ascii"))
+        for start in range(0, len(self.kids), 1024):
+            self.emit("".join(f" {idnum} 0 R" for idnum in self.kids[start:start + 1024]).encode("ascii"))
+        self.emit(b" ]\n>>\nendobj\n")
+        catalog = DictionaryObject()
+        catalog[NameObject("/Type")] = NameObject("/Catalog")
+        catalog[NameObject("/Pages")] = self.pages_ref
+        root = self.add_object(catalog)
+
+        xref = self.position
+        self.emit(f"xref\n0 {len(self.offsets) + 1}\n0000000000 65535 f \n".encode("ascii"))
+        for start in range(0, len(self.offsets), 1024):
+            self.emit("".join(f"{offset:010d} 00000 n \n" for offset in self.offsets[start:start + 1024]).encode("ascii"))
+        self.emit(
+            f"trailer\n<<\n/Size {len(self.offsets) + 1}\n/Root {root.idnum} 0 R\n>>\nstartxref\n{xref}\n%%EOF\n".encode("ascii")
+        )
+
+
+def iter_export_zip(
+    rendered: Iterable[Tuple[int, Dict[str, str], Optional[Attachment], Optional[Attachment], Optional[str]]],
+) -> Iterator[bytes]:
+    buffer = ExportBuffer()
+    errors = []
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for idx, student, pdf_attachment, jpg_attachment, render_error in rendered:
+            if render_error:
+                errors.append(f"{idx}\t{student['name']}\t{render_error}")
+            for attachment in (pdf_attachment, jpg_attachment):
+                if attachment:
+                    archive.writestr(f"{idx + 1:05d}_{attachment[0]}", attachment[1])
+            yield buffer.drain()
+        if errors:
+            archive.writestr("errors.txt", "\n".join(errors) + "\n")
+    yield buffer.drain()
+
+
+def render_export_error_pages(errors: List[Tuple[int, str, str]]) -> List[PyPDF2.PageObject]:
+    try:
+        font_name = get_active_font()
+    except FileNotFoundError:
+        font_name = "Helvetica"
+    width, height = letter
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=letter)
+    for start in range(0, len(errors), EXPORT_ERROR_LINES):
+        can.setFont(font_name, 14)
+        can.drawString(40, height - 50, f"Diplomas not rendered: {len(errors)}")
+        can.setFont(font_name, 9)
+        y = height - 80
+        for idx, name, error in errors[start:start + EXPORT_ERROR_LINES]:
+            display_name = name[::-1] if is_hebrew(name) else name
+            can.drawString(40, y, f"{idx}    {display_name}    {error}"[:EXPORT_ERROR_CHARS])
+            y -= 16
+        can.showPage()
+    can.save()
+    packet.seek(0)
+    return list(PyPDF2.PdfReader(packet).pages)
+
+
+def iter_export_pdf(
+    rows: Iterable[Tuple[int, Dict[str, str]]],
+    pdf_template_path: Path,
+    name_x_offset: int = 0,
+    name_y_offset: int = 0,
+) -> Iterator[bytes]:
+    template = load_pdf_template(pdf_template_path).pages[0]
+    writer = MergedPdfWriter()
+    with TEMPLATE_CACHE_LOCK:
+        template_ref = writer.add_form(template, {})
+    yield writer.buffer.drain()
+
+    errors: List[Tuple[int, str, str]] = []
+    rows = iter(rows)
+    for chunk in iter(lambda: list(itertools.islice(rows, RENDER_CHUNK_SIZE)), []):
+        names = [student["name"] for _, student in chunk]
+        try:
+            overlay_pages = render_overlay_pages(names, x_offset=name_x_offset, y_offset=name_y_offset)
+        except Exception:  # noqa: BLE001
+            overlay_pages = []
+            for idx, student in chunk:
+                try:
+                    overlay_pages.extend(
+                        render_overlay_pages([student["name"]], x_offset=name_x_offset, y_offset=name_y_offset)
+                    )
+                except Exception as exc:  # noqa: BLE001
+                    errors.append((idx, student["name"], str(exc)))
+                    overlay_pages.append(None)
+        refs: Dict[int, Dict[int, IndirectObject]] = {}
+        for (idx, student), overlay_page in zip(chunk, overlay_pages):
+            if overlay_page is None:
+                continue
+            overlay_refs = refs.setdefault(id(overlay_page.pdf), {})
+            try:
+                with writer.rollback_on_error(overlay_refs):
+                    overlay_ref = writer.add_form(overlay_page, overlay_refs)
+                    writer.add_page(template, [template_ref, overlay_ref])
+            except Exception as exc:  # noqa: BLE001
+                errors.append((idx, student["name"], str(exc)))
+        yield writer.buffer.drain()
+
+    if errors:
+        errors.sort()
+        refs = {}
+        for error_page in render_export_error_pages(errors):
+            writer.add_page(error_page, [writer.add_form(error_page, refs)])
+        yield writer.buffer.drain()
+
+    writer.finish()
+    yield writer.buffer.drain()
+
+
+@contextmanager
+def jobs_db() -> Iterator[sqlite3.Connection]:
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(JOBS_DB), timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def init_jobs_db() -> None:
+    with jobs_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, run_dir TEXT NOT NULL, params TEXT NOT NULL, "
+            "error TEXT NOT NULL DEFAULT '', created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_rows ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, name TEXT NOT NULL, email TEXT NOT NULL, "
+            "status TEXT NOT NULL, detail TEXT NOT NULL DEFAULT '', updated_at REAL NOT NULL, "
+            "PRIMARY KEY (job_id, idx))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, line TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sent_ledger ("
+            "campaign TEXT NOT NULL, email TEXT NOT NULL, sent_at REAL NOT NULL, "
+            "PRIMARY KEY (campaign, email)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS oauth_states ("
+            "state TEXT PRIMARY KEY, redirect_uri TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+
+
+def save_oauth_state(state: str, redirect_uri: str) -> None:
+    now = time.time()
+    with jobs_db() as conn:
+        conn.execute("DELETE FROM oauth_states WHERE created_at < ?", (now - OAUTH_STATE_TTL_SECONDS,))
+        conn.execute(
+            "INSERT OR REPLACE INTO oauth_states (state, redirect_uri, created_at) VALUES (?, ?, ?)",
+            (state, redirect_uri, now),
+        )
+
+
+def take_oauth_state(state: str) -> Tuple[bool, Optional[str]]:
+    with jobs_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM oauth_states WHERE created_at < ?", (time.time() - OAUTH_STATE_TTL_SECONDS,))
+        if state:
+            row = conn.execute("SELECT redirect_uri FROM oauth_states WHERE state = ?", (state,)).fetchone()
+            conn.execute("DELETE FROM oauth_states WHERE state = ?", (state,))
+        else:
+            row = conn.execute("SELECT redirect_uri FROM oauth_states ORDER BY created_at DESC LIMIT 1").fetchone()
+        pending = row is not None or conn.execute("SELECT 1 FROM oauth_states LIMIT 1").fetchone() is not None
+    return pending, row["redirect_uri"] if row else None
+
+
+def sent_ledger_enabled() -> bool:
+    return os.environ.get(SENT_LEDGER_ENV, "1").strip().lower() not in {"0", "false", "no"}
+
+
+def get_campaign_key(campaign: str, pdf_template_path: Optional[Path], jpg_template_path: Optional[Path]) -> Optional[str]:
+    if not sent_ledger_enabled():
+        return None
+    campaign = campaign.strip()
+    if campaign:
+        return f"name:{campaign}"
+    digest = hashlib.sha256()
+    for path in (pdf_template_path, jpg_template_path):
+        digest.update((file_content_hash(path) if path else "").encode("ascii") + b"\0")
+    return digest.hexdigest()
+
+
+def ledger_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def find_sent(campaign: str, emails: List[str]) -> set:
+    if not emails:
+        return set()
+    placeholders = ",".join("?" * len(emails))
+    with jobs_db() as conn:
+        rows = conn.execute(
+            f"SELECT email FROM sent_ledger WHERE campaign = ? AND email IN ({placeholders})",
+            [campaign, *emails],
+        ).fetchall()
+    return {row["email"] for row in rows}
+
+
+def record_sent(campaign: str, emails: List[str]) -> None:
+    now = time.time()
+    with jobs_db() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO sent_ledger (campaign, email, sent_at) VALUES (?, ?, ?)",
+            [(campaign, email, now) for email in emails],
+        )
+
+
+def add_job_event(conn: sqlite3.Connection, job_id: str, line: str) -> None:
+    conn.execute("INSERT INTO job_events (job_id, line) VALUES (?, ?)", (job_id, line))
+
+
+def set_job_status(job_id: str, status: str, error: str = "") -> None:
+    with jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, error, time.time(), job_id),
+        )
+
+
+def create_job(run_dir: Path, params: Dict[str, Any], students: Iterable[Dict[str, str]], selected: set) -> str:
+    job_id = uuid.uuid4().hex[:12]
+    now = time.time()
+    with jobs_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, run_dir, params, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+            (job_id, str(run_dir), json.dumps(params), now, now),
+        )
+        skipped_rows = []
+        for idx, student in split_eligible(students, selected, skipped_rows, params.get("campaign")):
+            conn.execute(
+                "INSERT INTO job_rows (job_id, idx, name, email, status, detail, updated_at) VALUES (?, ?, ?, ?, 'pending', '', ?)",
+                (job_id, idx, student["name"], student["email"], now),
+            )
+        for idx, student, reason in skipped_rows:
+            conn.execute(
+                "INSERT INTO job_rows (job_id, idx, name, email, status, detail, updated_at) VALUES (?, ?, ?, ?, 'skipped', ?, ?)",
+                (job_id, idx, student["name"], student["email"], reason, now),
+            )
+            if student["email"] or reason == "Missing email":
+                add_job_event(conn, job_id, f"skip:{student['email'] or student['name']}")
+    JOB_WAKEUP.set()
+    return job_id
+
+
+def claim_next_job() -> Optional[str]:
+    with jobs_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (time.time(), row["id"]))
+        return row["id"]
+
+
+def process_job(job_id: str) -> None:
+    with jobs_db() as conn:
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        rows = conn.execute(
+            "SELECT idx, name, email FROM job_rows WHERE job_id = ? AND status IN ('pending', 'error') ORDER BY idx",
+            (job_id,),
+        ).fetchall()
+    params = json.loads(job["params"])
+    run_dir = Path(job["run_dir"])
+
+    credentials = load_credentials()
+    if not credentials:
+        set_job_status(job_id, "failed", "Not connected to Gmail. Click Connect Google first.")
+        return
+
+    pdf_path = Path(params["pdf_path"]) if params.get("pdf_path") else None
+    jpg_template_path = Path(params["jpg_template_path"]) if params.get("jpg_template_path") else None
+    logo_bytes = Path(params["logo_path"]).read_bytes() if params.get("logo_path") else None
+    students = ((row["idx"], {"name": row["name"], "email": row["email"], "new": "1", "send": ""}) for row in rows)
+    scheduler = create_send_scheduler()
+    message_template = MessageTemplate(
+        params["html_content"], params["subject"], params["from_email"], logo_bytes, params.get("logo_filename")
+    )
+
+    rendered = render_diplomas(
+        students,
+        pdf_path,
+        jpg_template_path,
+        run_dir,
+        params.get("name_x_offset", 0),
+        params.get("name_y_offset", 0),
+    )
+    for group in group_rendered(rendered, get_gmail_batch_size()):
+        with jobs_db() as conn:
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+            for idx, _, _, _, _ in group:
+                conn.execute(
+                    "UPDATE job_rows SET status = 'sending', updated_at = ? WHERE job_id = ? AND idx = ?",
+                    (time.time(), job_id, idx),
+                )
+        outcomes = send_diploma_group(
+            [entry[1:] for entry in group],
+            credentials,
+            message_template,
+            scheduler=scheduler,
+            campaign=params.get("campaign"),
+        )
+        with jobs_db() as conn:
+            for (idx, student, _, _, _), error in zip(group, outcomes):
+                conn.execute(
+                    "UPDATE job_rows SET status = ?, detail = ?, updated_at = ? WHERE job_id = ? AND idx = ?",
+                    ("sent" if error is None else "error", error or "", time.time(), job_id, idx),
+                )
+                if error is None:
+                    add_job_event(conn, job_id, f"send:{student['email']}")
+                else:
+                    add_job_event(conn, job_id, f"error:{student['email']}:{error}")
+
+    summary = get_job_result(job_id)["summary"]
+    with jobs_db() as conn:
+        try:
+            send_batch_notification(credentials, params["from_email"], summary["sent"])
+        except Exception as exc:  # noqa: BLE001
+            add_job_event(conn, job_id, f"notify_error:{str(exc)}")
+        state = scheduler.snapshot()
+        add_job_event(conn, job_id, f"rate:{state['rate']} retries={state['retries']} throttled={state['throttled']}")
+        add_job_event(conn, job_id, f"summary: sent={summary['sent']} skipped={summary['skipped']}")
+        conn.execute("UPDATE jobs SET status = 'completed', updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+
+def heartbeat_job(job_id: str, stop: threading.Event) -> None:
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            with jobs_db() as conn:
+                conn.execute(
+                    "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id)
+                )
+        except Exception:  # noqa: BLE001
+            pass
+
+
+def run_job_worker() -> None:
+    recovered_at = time.monotonic()
+    while True:
+        try:
+            job_id = claim_next_job()
+        except Exception:  # noqa: BLE001
+            job_id = None
+        if job_id is None:
+            if time.monotonic() - recovered_at >= JOB_HEARTBEAT_SECONDS:
+                recovered_at = time.monotonic()
+                try:
+                    recover_jobs()
+                except Exception:  # noqa: BLE001
+                    pass
+            JOB_WAKEUP.wait(JOB_POLL_SECONDS)
+            JOB_WAKEUP.clear()
+            continue
+        stop = threading.Event()
+        threading.Thread(target=heartbeat_job, args=(job_id, stop), name="diploma-job-heartbeat", daemon=True).start()
+        try:
+            process_job(job_id)
+        except Exception as exc:  # noqa: BLE001
+            set_job_status(job_id, "failed", str(exc))
+        finally:
+            stop.set()
+
+
+def settle_sending_rows(conn: sqlite3.Connection, job_id: str, now: float) -> None:
+    job = conn.execute("SELECT params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    campaign = json.loads(job["params"]).get("campaign") if job else None
+    rows = conn.execute(
+        "SELECT idx, email FROM job_rows WHERE job_id = ? AND status = 'sending'", (job_id,)
+    ).fetchall()
+    for row in rows:
+        sent = campaign and conn.execute(
+            "SELECT 1 FROM sent_ledger WHERE campaign = ? AND email = ?", (campaign, ledger_email(row["email"]))
+        ).fetchone()
+        if sent:
+            conn.execute(
+                "UPDATE job_rows SET status = 'sent', detail = '', updated_at = ? WHERE job_id = ? AND idx = ?",
+                (now, job_id, row["idx"]),
+            )
+            add_job_event(conn, job_id, f"send:{row['email']}")
+        else:
+            conn.execute(
+                "UPDATE job_rows SET status = 'interrupted', detail = 'Interrupted while sending; verify before resending.', "
+                "updated_at = ? WHERE job_id = ? AND idx = ?",
+                (now, job_id, row["idx"]),
+            )
+
+
+def recover_jobs() -> None:
+    auto_resume = os.environ.get(JOBS_AUTO_RESUME_ENV, "1").strip().lower() in {"1", "true", "yes"}
+    now = time.time()
+    with jobs_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        stale = [
+            row["id"]
+            for row in conn.execute(
+                "SELECT id FROM jobs WHERE status = 'running' AND updated_at < ?", (now - JOB_LEASE_SECONDS,)
+            )
+        ]
+        orphaned = [
+            row["job_id"]
+            for row in conn.execute(
+                "SELECT DISTINCT job_id FROM job_rows WHERE status = 'sending' "
+                "AND job_id IN (SELECT id FROM jobs WHERE status != 'running')"
+            )
+        ]
+        for job_id in orphaned + stale:
+            settle_sending_rows(conn, job_id, now)
+        for job_id in stale:
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                ("queued" if auto_resume else "interrupted", now, job_id),
+            )
+
+
+def start_job_worker() -> None:
+    global JOB_WORKER
+    if JOB_WORKER is not None and JOB_WORKER.is_alive():
+        return
+    init_jobs_db()
+    recover_jobs()
+    JOB_WORKER = threading.Thread(target=run_job_worker, name="diploma-job-worker", daemon=True)
+    JOB_WORKER.start()
+
+
+def get_job_result(job_id: str) -> Dict[str, Any]:
+    with jobs_db() as conn:
+        rows = conn.execute(
+            "SELECT idx, name, email, status, detail FROM job_rows WHERE job_id = ? ORDER BY idx",
+            (job_id,),
+        ).fetchall()
+    sent = [{"name": row["name"], "email": row["email"]} for row in rows if row["status"] == "sent"]
+    sent_indices = [row["idx"] for row in rows if row["status"] == "sent"]
+    skipped = [{"name": row["name"], "reason": row["detail"]} for row in rows if row["status"] == "skipped"]
+    errors = [
+        {"name": row["name"], "error": row["detail"]}
+        for row in rows
+        if row["status"] in {"error", "interrupted"}
+    ]
+    pending = sum(1 for row in rows if row["status"] in {"pending", "sending"})
+    return {
+        "sent_indices": sent_indices,
+        "sent": sent,
+        "skipped": skipped,
+        "errors": errors,
+        "summary": {"sent": len(sent), "skipped": len(skipped), "errors": len(errors), "pending": pending},
+    }
+
+
+def read_job_events(job_id: str, after: int) -> Tuple[List[Tuple[int, str]], Optional[str]]:
+    with jobs_db() as conn:
+        job = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        events = conn.execute(
+            "SELECT id, line FROM job_events WHERE job_id = ? AND id > ? ORDER BY id",
+            (job_id, after),
+        ).fetchall()
+    return [(event["id"], event["line"]) for event in events], job["status"] if job else None
+
+
+def get_retention_hours(kind: str) -> float:
+    env_name, default = OUTPUT_RETENTION[kind]
+    try:
+        return max(0.0, float(os.environ.get(env_name, "").strip() or default))
+    except ValueError:
+        return default
+
+
+def get_output_cap_bytes() -> int:
+    try:
+        cap_mb = float(os.environ.get(OUTPUT_MAX_MB_ENV, "").strip() or OUTPUT_MAX_MB_DEFAULT)
+    except ValueError:
+        cap_mb = OUTPUT_MAX_MB_DEFAULT
+    return int(max(0.0, cap_mb) * 1024 * 1024)
+
+
+def get_janitor_interval() -> float:
+    try:
+        return max(0.0, float(os.environ.get(JANITOR_INTERVAL_ENV, "").strip() or JANITOR_INTERVAL_DEFAULT))
+    except ValueError:
+        return JANITOR_INTERVAL_DEFAULT
+
+
+def directory_size(path: Path) -> int:
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(Path(entry.path))
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return total
+
+
+def list_output_runs() -> List[Dict[str, Any]]:
+    if not OUTPUT_DIR.exists():
+        return []
+    runs = []
+    for entry in os.scandir(OUTPUT_DIR):
+        kind = entry.name.split("-", 1)[0]
+        if kind not in OUTPUT_RETENTION or kind == "asset" or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            modified = entry.stat(follow_symlinks=False).st_mtime
+        except OSError:
+            continue
+        runs.append({
+            "name": entry.name,
+            "kind": kind,
+            "path": Path(entry.path),
+            "modified": modified,
+            "size": directory_size(Path(entry.path)),
+        })
+    runs.sort(key=lambda run: run["modified"])
+    return runs
+
+
+def list_assets() -> List[Dict[str, Any]]:
+    if not ASSETS_DIR.exists():
+        return []
+    assets = []
+    for entry in os.scandir(ASSETS_DIR):
+        if not ASSET_ID_PATTERN.fullmatch(entry.name) or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            modified = entry.stat(follow_symlinks=False).st_mtime
+        except OSError:
+            continue
+        assets.append({
+            "name": entry.name,
+            "kind": "asset",
+            "path": Path(entry.path),
+            "modified": modified,
+            "size": directory_size(Path(entry.path)),
+        })
+    assets.sort(key=lambda asset: asset["modified"])
+    return assets
+
+
+def active_asset_ids() -> set:
+    if not JOBS_DB.exists():
+        return set()
+    with jobs_db() as conn:
+        rows = conn.execute("SELECT params FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+    asset_ids = set()
+    for row in rows:
+        params = json.loads(row["params"])
+        for key in ("pdf_path", "jpg_template_path", "logo_path"):
+            if params.get(key):
+                asset_ids.add(Path(params[key]).parent.name)
+    return asset_ids
+
+
+def active_run_dirs() -> set:
+    if not JOBS_DB.exists():
+        return set()
+    with jobs_db() as conn:
+        rows = conn.execute("SELECT run_dir FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+    return {Path(row["run_dir"]).name for row in rows}
+
+
+def cleanup_output() -> Dict[str, Any]:
+    with JANITOR_LOCK:
+        now = time.time()
+        runs = sorted(list_output_runs() + list_assets(), key=lambda run: run["modified"])
+        protected = active_run_dirs() | active_asset_ids()
+        removed = []
+
+        def evict(run: Dict[str, Any], reason: str) -> None:
+            shutil.rmtree(run["path"], ignore_errors=True)
+            removed.append({"name": run["name"], "kind": run["kind"], "size": run["size"], "reason": reason})
+
+        kept = []
+        for run in runs:
+            if run["name"] in protected or now - run["modified"] < OUTPUT_MIN_AGE_SECONDS:
+                kept.append((run, False))
+                continue
+            retention_hours = get_retention_hours(run["kind"])
+            if retention_hours and now - run["modified"] > retention_hours * 3600:
+                evict(run, "expired")
+            else:
+                kept.append((run, True))
+
+        cap = get_output_cap_bytes()
+        total = sum(run["size"] for run, _ in kept)
+        for run, evictable in kept:
+            if not cap or total <= cap:
+                break
+            if evictable:
+                evict(run, "over_cap")
+                total -= run["size"]
+
+    return {"removed": removed, "freed_bytes": sum(run["size"] for run in removed), "total_bytes": total}
+
+
+def run_output_janitor(interval: float) -> None:
+    while True:
+        try:
+            cleanup_output()
+        except Exception:  # noqa: BLE001
+            pass
+        time.sleep(interval)
+
+
+def start_output_janitor() -> None:
+    global JANITOR_WORKER
+    interval = get_janitor_interval()
+    if not interval or (JANITOR_WORKER is not None and JANITOR_WORKER.is_alive()):
+        return
+    JANITOR_WORKER = threading.Thread(
+        target=run_output_janitor, args=(interval,), name="diploma-output-janitor", daemon=True
+    )
+    JANITOR_WORKER.start()
+
+
+def warm_up_enabled() -> bool:
+    return os.environ.get(WARM_UP_ENV, "1").strip().lower() not in {"0", "false", "no"}
 
 
-def decode_csv_content(content: bytes) -> str:
-    for encoding in ("utf-8-sig", "ascii", "latin-1"):
-        try:
-            return content.decode(encoding)
-        except UnicodeDecodeError:
-            continue
-    return content.decode("utf-8", errors="replace")
+def warm_up_fonts() -> None:
+    register_font_once()
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=letter)
+    for name in WARM_UP_NAMES:
+        draw_overlay_name(can, name)
+        can.showPage()
+    can.save()
 
 
-def normalize_student_row(row: Dict[str, str], fieldnames: List[str]) -> Dict[str, str]:
-    name_field = (row.get("name") or "").strip()
-    first = (row.get("first") or "").strip()
-    last = (row.get("last") or "").strip()
-    email = (row.get("email") or "").strip() or (row.get("mail") or "").strip()
-    new = (row.get("new") or "").strip()
-    send = (row.get("send") or "").strip()
+def warm_up_pil_fonts() -> None:
+    features.check("raqm")
+    font_path = get_active_font_path()
+    if font_path and font_path.exists():
+        load_truetype_font(str(font_path), max(10, int(42 * get_raster_dpi() / 72)))
 
-    has_name_field = "name" in fieldnames
-    full_name = name_field if has_name_field and name_field else f"{first} {last}".strip()
 
-    return {
-        "first": first,
-        "last": last,
-        "email": email,
-        "new": new,
-        "send": send,
-        "name": full_name,
-    }
+def warm_up_gmail_client() -> None:
+    import googleapiclient.errors  # noqa: F401
+    import googleapiclient.http  # noqa: F401
+    import httplib2  # noqa: F401
 
+    credentials = load_credentials()
+    if credentials:
+        get_gmail_address(credentials)
+
+
+def run_warm_up() -> None:
+    started = time.perf_counter()
+    for step, func in (
+        ("fonts", warm_up_fonts),
+        ("pil_fonts", warm_up_pil_fonts),
+        ("gmail_client", warm_up_gmail_client),
+    ):
+        step_started = time.perf_counter()
+        try:
+            func()
+            result: Any = round(time.perf_counter() - step_started, 4)
+        except Exception as exc:  # noqa: BLE001
+            result = f"error: {exc}"
+        with STARTUP_LOCK:
+            STARTUP_STATS["warm_up"][step] = result
+    with STARTUP_LOCK:
+        STARTUP_STATS["warm_up_seconds"] = round(time.perf_counter() - started, 4)
+
+
+def start_warm_up() -> None:
+    global WARM_UP_WORKER
+    if not warm_up_enabled() or (WARM_UP_WORKER is not None and WARM_UP_WORKER.is_alive()):
+        return
+    WARM_UP_WORKER = threading.Thread(target=run_warm_up, name="diploma-warm-up", daemon=True)
+    WARM_UP_WORKER.start()
 
-def parse_csv(content: bytes) -> List[Dict[str, str]]:
-    decoded = decode_csv_content(content)
-    reader = csv.DictReader(io.StringIO(decoded, newline=""))
-    rows = []
-    fieldnames = reader.fieldnames or []
-    for row in reader:
-        rows.append(normalize_student_row(row, fieldnames))
-    return rows
-
-
-def parse_csv_with_headers(content: bytes) -> Tuple[List[str], List[Dict[str, str]]]:
-    decoded = decode_csv_content(content)
-    reader = csv.DictReader(io.StringIO(decoded, newline=""))
-    fieldnames = reader.fieldnames or []
-    if "new" not in fieldnames:
-        fieldnames.append("new")
-    if "send" not in fieldnames:
-        fieldnames.append("send")
-    rows = []
-    for row in reader:
-        raw = {key: (row.get(key) or "").strip() for key in fieldnames}
-        normalized = normalize_student_row(raw, fieldnames)
-        rows.append({
-            "raw": raw,
-            "name": normalized["name"],
-            "email": normalized["email"],
-            "new": normalized["new"],
-            "send": normalized["send"],
-        })
-    return fieldnames, rows
 
-def save_upload(file: UploadFile, dest_dir: Path) -> Path:
-    dest_dir.mkdir(parents=True, exist_ok=True)
-    file_path = dest_dir / file.filename
-    content = file.file.read()
-    file_path.write_bytes(content)
-    return file_path
+def record_first_preview(started: float) -> None:
+    with STARTUP_LOCK:
+        if STARTUP_STATS["first_preview_seconds"] is None:
+            finished = time.perf_counter()
+            STARTUP_STATS["first_preview_seconds"] = round(finished - started, 4)
+            STARTUP_STATS["first_preview_since_import_seconds"] = round(finished - IMPORT_STARTED, 4)
 
 
-def save_bytes(filename: str, data: bytes, dest_dir: Path) -> Path:
-    dest_dir.mkdir(parents=True, exist_ok=True)
-    safe_name = Path(filename).name or "upload.bin"
-    file_path = dest_dir / safe_name
-    file_path.write_bytes(data)
-    return file_path
+def find_asset(asset_id: str) -> Optional[Path]:
+    if not ASSET_ID_PATTERN.fullmatch(asset_id):
+        return None
+    asset_dir = ASSETS_DIR / asset_id
+    if not asset_dir.is_dir():
+        return None
+    for path in asset_dir.iterdir():
+        if path.is_file() and not path.name.endswith(".tmp"):
+            try:
+                os.utime(asset_dir)
+            except OSError:
+                pass
+            return path
+    return None
+
+
+def store_asset(filename: str, data: bytes) -> Tuple[str, Path, bool]:
+    asset_id = hashlib.sha256(data).hexdigest()
+    existing = find_asset(asset_id)
+    if existing is not None:
+        return asset_id, existing, True
+    asset_dir = ASSETS_DIR / asset_id
+    asset_dir.mkdir(parents=True, exist_ok=True)
+    path = asset_dir / (Path(filename).name or "upload.bin")
+    tmp_path = asset_dir / f"{uuid.uuid4().hex}.tmp"
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+    return asset_id, path, False
+
+
+def resolve_asset(upload: Optional[UploadFile], asset_id: str = "") -> Optional[Path]:
+    if upload and upload.filename:
+        return store_asset(upload.filename, upload.file.read())[1]
+    asset_id = asset_id.strip()
+    if not asset_id:
+        return None
+    path = find_asset(asset_id)
+    if path is None:
+        raise FileNotFoundError(f"Unknown asset id: {asset_id}. Upload it again.")
+    return path
 
 
 @app.get("/oauth/start")
@@ -445,9 +3035,7 @@ def oauth_start(request: Request):
         include_granted_scopes="true",
         prompt="consent",
     )
-    global OAUTH_STATE, OAUTH_REDIRECT_URI
-    OAUTH_STATE = state
-    OAUTH_REDIRECT_URI = redirect_uri
+    save_oauth_state(state, redirect_uri)
     return RedirectResponse(auth_url)
 
 
@@ -455,10 +3043,11 @@ def oauth_start(request: Request):
 def oauth_callback(code: str = "", state: str = ""):
     if not code:
         return HTMLResponse("Missing OAuth code.", status_code=400)
-    if OAUTH_STATE and state and state != OAUTH_STATE:
+    pending, saved_redirect_uri = take_oauth_state(state)
+    if pending and state and saved_redirect_uri is None:
         return HTMLResponse("Invalid OAuth state. Please try again.", status_code=400)
 
-    redirect_uri = OAUTH_REDIRECT_URI or os.environ.get("GMAIL_OAUTH_REDIRECT_URI") or ""
+    redirect_uri = saved_redirect_uri or os.environ.get("GMAIL_OAUTH_REDIRECT_URI") or ""
     if not redirect_uri:
         return HTMLResponse("Missing redirect URI. Set GMAIL_OAUTH_REDIRECT_URI.", status_code=400)
 
@@ -495,16 +3084,55 @@ def oauth_check_setup():
 
 @app.post("/oauth/logout")
 def oauth_logout():
-    if TOKEN_FILE.exists():
-        TOKEN_FILE.unlink()
+    delete_credentials()
     return {"ok": True}
 
 
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/gmail-stats")
+def gmail_stats():
+    with GMAIL_SERVICES_LOCK:
+        stats = dict(GMAIL_STATS)
+        message_stats = dict(MESSAGE_STATS)
+        cached_services = len(GMAIL_SERVICES)
+    with CREDENTIAL_LOCK:
+        credential_stats = dict(CREDENTIAL_STATS)
+    avg_build_ms = stats["build_seconds"] * 1000 / stats["builds"] if stats["builds"] else 0.0
+    avg_send_ms = stats["send_seconds"] * 1000 / stats["sends"] if stats["sends"] else 0.0
+    messages = message_stats["messages"]
+    avg_message_ms = message_stats["message_seconds"] * 1000 / messages if messages else 0.0
+    avg_message_kb = message_stats["message_bytes"] / 1024 / messages if messages else 0.0
+    return {
+        "ok": True,
+        "cache_enabled": gmail_service_cache_enabled(),
+        "cached_services": cached_services,
+        "builds": stats["builds"],
+        "reuses": stats["reuses"],
+        "sends": stats["sends"],
+        "avg_build_ms": round(avg_build_ms, 2),
+        "avg_send_ms": round(avg_send_ms, 2),
+        "estimated_saved_ms": round(avg_build_ms * stats["reuses"], 2),
+        "compiled_messages": compiled_messages_enabled(),
+        "messages_built": messages,
+        "avg_message_build_ms": round(avg_message_ms, 3),
+        "avg_message_kb": round(avg_message_kb, 2),
+        "credential_cache_enabled": credential_cache_enabled(),
+        "credential_cache": credential_stats,
+    }
+
+
 @app.post("/api/test-send")
 def test_send(
     pdf_template: Optional[UploadFile] = File(None),
     jpg_template: Optional[UploadFile] = File(None),
     logo_file: Optional[UploadFile] = File(None),
+    pdf_asset_id: str = Form(""),
+    jpg_asset_id: str = Form(""),
+    logo_asset_id: str = Form(""),
     html_content: str = Form(""),
     text_content: str = Form(""),
     letter_format: str = Form("html"),
@@ -518,12 +3146,12 @@ def test_send(
     run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
     run_dir = OUTPUT_DIR / f"test-{run_id}"
 
-    pdf_path = None
-    if pdf_template and pdf_template.filename:
-        pdf_path = save_upload(pdf_template, run_dir)
-    jpg_template_path = None
-    if jpg_template and jpg_template.filename:
-        jpg_template_path = save_upload(jpg_template, run_dir)
+    try:
+        pdf_path = resolve_asset(pdf_template, pdf_asset_id)
+        jpg_template_path = resolve_asset(jpg_template, jpg_asset_id)
+        logo_path = resolve_asset(logo_file, logo_asset_id)
+    except FileNotFoundError as exc:
+        return JSONResponse({"ok": False, "error": str(exc)}, status_code=400)
 
     credentials = load_credentials()
     if not credentials:
@@ -562,12 +3190,17 @@ def test_send(
             name_x_offset=name_x_offset,
             name_y_offset=name_y_offset,
         )
+    elif pdf_path and pdf_jpg_copy_enabled():
+        jpg_output = generate_diploma_jpg_copy(
+            pdf_path,
+            test_name,
+            run_dir,
+            name_x_offset=name_x_offset,
+            name_y_offset=name_y_offset,
+        )
 
-    logo_bytes = None
-    logo_filename = None
-    if logo_file and logo_file.filename:
-        logo_bytes = logo_file.file.read()
-        logo_filename = Path(logo_file.filename).name
+    logo_bytes = logo_path.read_bytes() if logo_path else None
+    logo_filename = logo_path.name if logo_path else None
 
     if logo_bytes:
         html_content = inject_logo_cid(html_content)
@@ -588,72 +3221,163 @@ def test_send(
     return {"ok": True, "message": f"Test email sent to {test_email}", "output_dir": str(run_dir)}
 
 
+@app.post("/api/assets")
+def upload_asset(file: UploadFile = File(...)):
+    if not file.filename:
+        return JSONResponse({"ok": False, "error": "Missing file."}, status_code=400)
+    data = file.file.read()
+    asset_id, path, existing = store_asset(file.filename, data)
+    return {"ok": True, "id": asset_id, "filename": path.name, "size": len(data), "existing": existing}
+
+
+@app.get("/api/assets/{asset_id}")
+def get_asset(asset_id: str):
+    path = find_asset(asset_id)
+    if path is None:
+        return JSONResponse({"ok": False, "error": "Asset not found."}, status_code=404)
+    return {"ok": True, "id": asset_id, "filename": path.name, "size": path.stat().st_size}
+
+
+@app.post("/api/font-report")
+def font_report(
+    pdf_template: Optional[UploadFile] = File(None),
+    pdf_asset_id: str = Form(""),
+    csv_file: Optional[UploadFile] = File(None),
+    names: str = Form(""),
+    name_x_offset: int = Form(0),
+    name_y_offset: int = Form(0),
+):
+    try:
+        pdf_path = resolve_asset(pdf_template, pdf_asset_id)
+    except FileNotFoundError as exc:
+        return JSONResponse({"ok": False, "error": str(exc)}, status_code=400)
+    if not pdf_path:
+        return JSONResponse({"ok": False, "error": "Missing PDF template."}, status_code=400)
+
+    sample = [name.strip() for name in names.splitlines() if name.strip()]
+    if csv_file and csv_file.filename:
+        roster_names = (student["name"] for student in iter_csv_students(csv_file.file) if student["name"])
+        sample.extend(itertools.islice(roster_names, FONT_REPORT_SAMPLE))
+    sample = sample[:FONT_REPORT_SAMPLE]
+    if not sample:
+        return JSONResponse({"ok": False, "error": "Missing names."}, status_code=400)
+
+    return {
+        "ok": True,
+        "mode": get_font_subset_mode(),
+        "sample": len(sample),
+        "template_bytes": pdf_path.stat().st_size,
+        "modes": font_subset_report(pdf_path, sample, name_x_offset, name_y_offset),
+    }
+
+
 @app.post("/api/preview")
-def preview_csv(csv_file: UploadFile = File(...)):
-    csv_bytes = csv_file.file.read()
-    headers, students = parse_csv_with_headers(csv_bytes)
+def preview_csv(
+    csv_file: UploadFile = File(...),
+    offset: int = Form(0),
+    limit: int = Form(0),
+    filter: str = Form("all"),
+    include_raw: bool = Form(True),
+):
+    if filter not in PREVIEW_FILTERS:
+        return JSONResponse({"ok": False, "error": f"Unknown filter: {filter}"}, status_code=400)
+    offset = max(0, offset)
+    headers, students = iter_csv_with_headers(csv_file.file)
     preview = []
+    total = 0
+    matched = 0
     for idx, student in enumerate(students):
+        total += 1
         eligible = student["new"] == "1" and student["send"] == ""
-        preview.append({
+        if filter == "eligible" and not eligible or filter == "ineligible" and eligible:
+            continue
+        matched += 1
+        if matched <= offset or limit > 0 and len(preview) >= limit:
+            continue
+        row = {
             "index": idx,
             "name": student["name"],
             "email": student["email"],
             "new": student["new"],
             "send": student["send"],
             "eligible": eligible,
-            "raw": student["raw"],
-        })
-    return {"ok": True, "headers": headers, "rows": preview}
+        }
+        if include_raw:
+            row["raw"] = student["raw"]
+        preview.append(row)
+    return {
+        "ok": True,
+        "headers": headers,
+        "rows": preview,
+        "total": total,
+        "matched": matched,
+        "offset": offset,
+        "limit": limit,
+    }
 
 
 @app.post("/api/preview-pdf")
 def preview_pdf(
     pdf_template: Optional[UploadFile] = File(None),
     jpg_template: Optional[UploadFile] = File(None),
+    pdf_asset_id: str = Form(""),
+    jpg_asset_id: str = Form(""),
     test_name: str = Form(""),
     name_x_offset: int = Form(0),
     name_y_offset: int = Form(0),
+    profile: str = Form(""),
+    x_diploma_profile: str = HeaderParam(""),
 ):
+    started = time.perf_counter()
     if not test_name.strip():
         return JSONResponse({"ok": False, "error": "Missing test name."}, status_code=400)
 
     run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
     run_dir = OUTPUT_DIR / f"preview-{run_id}"
 
-    pdf_path = None
-    if pdf_template and pdf_template.filename:
-        pdf_path = save_upload(pdf_template, run_dir)
-    jpg_template_path = None
-    jpg_received = bool(jpg_template and jpg_template.filename)
-    if jpg_received:
-        jpg_template_path = save_upload(jpg_template, run_dir)
-
-    pdf_url = None
-    if pdf_path:
-        pdf_output = generate_diploma_pdf(
-            pdf_path,
-            test_name.strip(),
-            run_dir,
-            name_x_offset=name_x_offset,
-            name_y_offset=name_y_offset,
-        )
-        pdf_url = f"/output/{pdf_output.parent.name}/{pdf_output.name}"
-    jpg_url = None
-    if jpg_template_path:
-        jpg_output = generate_diploma_jpg(
-            jpg_template_path,
-            test_name.strip(),
-            run_dir,
-            name_x_offset=name_x_offset,
-            name_y_offset=name_y_offset,
-        )
-        jpg_url = f"/output/{jpg_output.parent.name}/{jpg_output.name}"
+    try:
+        pdf_path = resolve_asset(pdf_template, pdf_asset_id)
+        jpg_template_path = resolve_asset(jpg_template, jpg_asset_id)
+    except FileNotFoundError as exc:
+        return JSONResponse({"ok": False, "error": str(exc)}, status_code=400)
+    jpg_received = jpg_template_path is not None
+
+    with RunProfiler(run_dir, profiling_requested(profile, x_diploma_profile)) as profiler:
+        pdf_url = None
+        if pdf_path:
+            pdf_output = generate_diploma_pdf(
+                pdf_path,
+                test_name.strip(),
+                run_dir,
+                name_x_offset=name_x_offset,
+                name_y_offset=name_y_offset,
+            )
+            pdf_url = f"/output/{pdf_output.parent.name}/{pdf_output.name}"
+        jpg_output = None
+        if jpg_template_path:
+            jpg_output = generate_diploma_jpg(
+                jpg_template_path,
+                test_name.strip(),
+                run_dir,
+                name_x_offset=name_x_offset,
+                name_y_offset=name_y_offset,
+            )
+        elif pdf_path and pdf_jpg_copy_enabled():
+            jpg_output = generate_diploma_jpg_copy(
+                pdf_path,
+                test_name.strip(),
+                run_dir,
+                name_x_offset=name_x_offset,
+                name_y_offset=name_y_offset,
+            )
+    jpg_url = f"/output/{jpg_output.parent.name}/{jpg_output.name}" if jpg_output else None
+    record_first_preview(started)
     return {
         "ok": True,
         "pdf_url": pdf_url,
         "jpg_url": jpg_url,
         "jpg_received": jpg_received,
+        "profile": profiler.report,
     }
 
 
@@ -663,30 +3387,33 @@ def send_batch(
     pdf_template: Optional[UploadFile] = File(None),
     jpg_template: Optional[UploadFile] = File(None),
     logo_file: Optional[UploadFile] = File(None),
+    pdf_asset_id: str = Form(""),
+    jpg_asset_id: str = Form(""),
+    logo_asset_id: str = Form(""),
     html_content: str = Form(""),
     text_content: str = Form(""),
     letter_format: str = Form("html"),
     subject: str = Form(""),
     selected_indices: str = Form(""),
+    campaign: str = Form(""),
     from_email: str = Form(""),
     name_x_offset: int = Form(0),
     name_y_offset: int = Form(0),
+    profile: str = Form(""),
+    x_diploma_profile: str = HeaderParam(""),
 ):
     run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
     run_dir = OUTPUT_DIR / f"batch-{run_id}"
 
-    if not pdf_template and not jpg_template:
+    try:
+        pdf_path = resolve_asset(pdf_template, pdf_asset_id)
+        jpg_template_path = resolve_asset(jpg_template, jpg_asset_id)
+        logo_path = resolve_asset(logo_file, logo_asset_id)
+    except FileNotFoundError as exc:
+        return JSONResponse({"ok": False, "error": str(exc)}, status_code=400)
+    if not pdf_path and not jpg_template_path:
         return JSONResponse({"ok": False, "error": "Missing PDF or JPG template."}, status_code=400)
 
-    pdf_path = None
-    if pdf_template and pdf_template.filename:
-        pdf_path = save_upload(pdf_template, run_dir)
-    jpg_template_path = None
-    if jpg_template and jpg_template.filename:
-        jpg_template_path = save_upload(jpg_template, run_dir)
-    csv_bytes = csv_file.file.read()
-    students = parse_csv(csv_bytes)
-
     credentials = load_credentials()
     if not credentials:
         return JSONResponse({"ok": False, "error": "Not connected to Gmail. Click Connect Google first."}, status_code=400)
@@ -705,18 +3432,10 @@ def send_batch(
     if not html_content:
         return JSONResponse({"ok": False, "error": "Letter content is empty."}, status_code=400)
 
-    selected = set()
-    if selected_indices.strip():
-        for chunk in selected_indices.split(","):
-            chunk = chunk.strip()
-            if chunk.isdigit():
-                selected.add(int(chunk))
+    selected = parse_selected_indices(selected_indices)
 
-    logo_bytes = None
-    logo_filename = None
-    if logo_file and logo_file.filename:
-        logo_bytes = logo_file.file.read()
-        logo_filename = Path(logo_file.filename).name
+    logo_bytes = logo_path.read_bytes() if logo_path else None
+    logo_filename = logo_path.name if logo_path else None
 
     if logo_bytes:
         html_content = inject_logo_cid(html_content)
@@ -726,58 +3445,36 @@ def send_batch(
     skipped = []
     errors = []
     log_lines = []
-
-    for idx, student in enumerate(students):
-        if selected and idx not in selected:
-            skipped.append({"name": student["name"], "reason": "Not selected"})
-            if student["email"]:
-                log_lines.append(f"skip:{student['email']}")
-            continue
-        if not student["email"]:
-            skipped.append({"name": student["name"], "reason": "Missing email"})
-            log_lines.append(f"skip:{student['name']}")
-            continue
-        if student["new"] != "1" or student["send"] != "":
-            skipped.append({"name": student["name"], "reason": "Not eligible or already sent"})
-            log_lines.append(f"skip:{student['email']}")
-            continue
-
-        try:
-            pdf_output = None
-            if pdf_path:
-                pdf_output = generate_diploma_pdf(
-                    pdf_path,
-                    student["name"],
-                    run_dir,
-                    name_x_offset=name_x_offset,
-                    name_y_offset=name_y_offset,
-                )
-            jpg_output = None
-            if jpg_template_path:
-                jpg_output = generate_diploma_jpg(
-                    jpg_template_path,
-                    student["name"],
-                    run_dir,
-                    name_x_offset=name_x_offset,
-                    name_y_offset=name_y_offset,
-                )
-            message = build_message(
-                student_name=student["name"],
-                student_email=student["email"],
-                html_content=html_content,
-                subject=subject or DEFAULT_SUBJECT,
-                from_email=from_email,
-                pdf_filename=pdf_output,
-                jpg_filename=jpg_output,
-                logo_bytes=logo_bytes,
-                logo_filename=logo_filename,
+    send_lines = []
+
+    with RunProfiler(run_dir, profiling_requested(profile, x_diploma_profile)) as profiler:
+        scheduler = create_send_scheduler()
+        message_template = MessageTemplate(html_content, subject, from_email, logo_bytes, logo_filename)
+        pdf_output = new_pdf_output_report(pdf_path)
+        campaign_key = get_campaign_key(campaign, pdf_path, jpg_template_path)
+        if campaign_key:
+            init_jobs_db()
+        skipped_rows = []
+        eligible = split_eligible(iter_csv_students(csv_file.file), selected, skipped_rows, campaign_key)
+        rendered = render_diplomas(eligible, pdf_path, jpg_template_path, run_dir, name_x_offset, name_y_offset)
+        for group in group_rendered(rendered, get_gmail_batch_size()):
+            outcomes = send_diploma_group(
+                [entry[1:] for entry in group], credentials, message_template, scheduler=scheduler, campaign=campaign_key
             )
-            send_email_gmail(message, credentials)
-            sent.append({"name": student["name"], "email": student["email"]})
-            sent_indices.append(idx)
-            log_lines.append(f"send:{student['email']}")
-        except Exception as exc:  # noqa: BLE001
-            errors.append({"name": student["name"], "error": str(exc)})
+            for (idx, student, pdf_attachment, _, _), error in zip(group, outcomes):
+                count_pdf_output(pdf_output, pdf_attachment)
+                if error is None:
+                    sent.append({"name": student["name"], "email": student["email"]})
+                    sent_indices.append(idx)
+                    send_lines.append(f"send:{student['email']}")
+                else:
+                    errors.append({"name": student["name"], "error": error})
+
+    for _, student, reason in skipped_rows:
+        skipped.append({"name": student["name"], "reason": reason})
+        if student["email"] or reason == "Missing email":
+            log_lines.append(f"skip:{student['email'] or student['name']}")
+    log_lines.extend(send_lines)
 
     try:
         send_batch_notification(credentials, from_email, len(sent))
@@ -796,43 +3493,57 @@ def send_batch(
             "sent": len(sent),
             "skipped": len(skipped),
         },
+        "scheduler": scheduler.snapshot(),
+        "campaign": campaign_key,
+        "pdf_output": pdf_output,
+        "profile": profiler.report,
     }
 
 
 @app.post("/api/send-stream")
 async def send_batch_stream(
+    request: Request,
     csv_file: UploadFile = File(...),
     pdf_template: Optional[UploadFile] = File(None),
     jpg_template: Optional[UploadFile] = File(None),
     logo_file: Optional[UploadFile] = File(None),
+    pdf_asset_id: str = Form(""),
+    jpg_asset_id: str = Form(""),
+    logo_asset_id: str = Form(""),
     html_content: str = Form(""),
     text_content: str = Form(""),
     letter_format: str = Form("html"),
     subject: str = Form(""),
     selected_indices: str = Form(""),
+    campaign: str = Form(""),
     from_email: str = Form(""),
     name_x_offset: int = Form(0),
     name_y_offset: int = Form(0),
+    profile: str = Form(""),
+    x_diploma_profile: str = HeaderParam(""),
 ):
     run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
     run_dir = OUTPUT_DIR / f"batch-{run_id}"
 
-    csv_bytes = await csv_file.read()
-    if not pdf_template and not jpg_template:
+    try:
+        pdf_path = await run_in_threadpool(resolve_asset, pdf_template, pdf_asset_id)
+        jpg_template_path = await run_in_threadpool(resolve_asset, jpg_template, jpg_asset_id)
+        logo_path = await run_in_threadpool(resolve_asset, logo_file, logo_asset_id)
+    except FileNotFoundError as exc:
+        return JSONResponse({"ok": False, "error": str(exc)}, status_code=400)
+    if not pdf_path and not jpg_template_path:
         return JSONResponse({"ok": False, "error": "Missing PDF or JPG template."}, status_code=400)
 
-    pdf_bytes = await pdf_template.read() if pdf_template else None
-    jpg_bytes = await jpg_template.read() if jpg_template and jpg_template.filename else None
-    logo_bytes = await logo_file.read() if logo_file and logo_file.filename else None
-    logo_filename = Path(logo_file.filename).name if logo_file and logo_file.filename else None
+    logo_bytes = await run_in_threadpool(logo_path.read_bytes) if logo_path else None
+    logo_filename = logo_path.name if logo_path else None
 
-    credentials = load_credentials()
+    credentials = await run_in_threadpool(load_credentials)
     if not credentials:
         return JSONResponse({"ok": False, "error": "Not connected to Gmail. Click Connect Google first."}, status_code=400)
 
     if not from_email:
         try:
-            from_email = get_gmail_address(credentials)
+            from_email = await run_in_threadpool(get_gmail_address, credentials)
         except Exception:
             from_email = ""
 
@@ -847,98 +3558,373 @@ async def send_batch_stream(
     if logo_bytes:
         html_content = inject_logo_cid(html_content)
 
-    pdf_path = None
-    if pdf_template and pdf_bytes is not None:
-        pdf_path = save_bytes(pdf_template.filename or "template.pdf", pdf_bytes, run_dir)
-    jpg_template_path = None
-    if jpg_bytes and jpg_template and jpg_template.filename:
-        jpg_template_path = save_bytes(jpg_template.filename or "template.jpg", jpg_bytes, run_dir)
-    students = parse_csv(csv_bytes)
-
-    selected = set()
-    if selected_indices.strip():
-        for chunk in selected_indices.split(","):
-            chunk = chunk.strip()
-            if chunk.isdigit():
-                selected.add(int(chunk))
+    selected = parse_selected_indices(selected_indices)
+    concurrency = get_send_concurrency()
+    scheduler = create_send_scheduler()
+    message_template = MessageTemplate(html_content, subject, from_email, logo_bytes, logo_filename)
+    pdf_output = await run_in_threadpool(new_pdf_output_report, pdf_path)
+    campaign_key = await run_in_threadpool(get_campaign_key, campaign, pdf_path, jpg_template_path)
+    if campaign_key:
+        await run_in_threadpool(init_jobs_db)
 
     sent = []
     sent_indices = []
     skipped = []
     errors = []
 
-    async def event_stream():
-        for idx, student in enumerate(students):
-            if selected and idx not in selected:
-                skipped.append({"name": student["name"], "reason": "Not selected"})
-                if student["email"]:
-                    yield f"skip:{student['email']}\n"
-                continue
-            if not student["email"]:
-                skipped.append({"name": student["name"], "reason": "Missing email"})
-                yield f"skip:{student['name']}\n"
-                continue
-            if student["new"] != "1" or student["send"] != "":
-                skipped.append({"name": student["name"], "reason": "Not eligible or already sent"})
-                yield f"skip:{student['email']}\n"
-                continue
+    async def deliver(
+        group: List[Tuple[int, Dict[str, str], Optional[Attachment], Optional[Attachment], Optional[str]]],
+    ) -> List[str]:
+        try:
+            outcomes = await run_in_threadpool(
+                call_profiled,
+                send_diploma_group,
+                [entry[1:] for entry in group],
+                credentials,
+                message_template,
+                scheduler,
+                campaign_key,
+            )
+        except Exception as exc:  # noqa: BLE001
+            outcomes = [str(exc)] * len(group)
 
-            try:
-                pdf_output = None
-                if pdf_path:
-                    pdf_output = generate_diploma_pdf(
-                        pdf_path,
-                        student["name"],
-                        run_dir,
-                        name_x_offset=name_x_offset,
-                        name_y_offset=name_y_offset,
-                    )
-                jpg_output = None
-                if jpg_template_path:
-                    jpg_output = generate_diploma_jpg(
-                        jpg_template_path,
-                        student["name"],
-                        run_dir,
-                        name_x_offset=name_x_offset,
-                        name_y_offset=name_y_offset,
-                    )
-                message = build_message(
-                    student_name=student["name"],
-                    student_email=student["email"],
-                    html_content=html_content,
-                    subject=subject or DEFAULT_SUBJECT,
-                    from_email=from_email,
-                    pdf_filename=pdf_output,
-                    jpg_filename=jpg_output,
-                    logo_bytes=logo_bytes,
-                    logo_filename=logo_filename,
-                )
-                send_email_gmail(message, credentials)
+        lines = []
+        for (idx, student, _, _, _), error in zip(group, outcomes):
+            if error is None:
                 sent.append({"name": student["name"], "email": student["email"]})
                 sent_indices.append(idx)
-                yield f"send:{student['email']}\n"
-            except Exception as exc:  # noqa: BLE001
-                errors.append({"name": student["name"], "error": str(exc)})
-                yield f"error:{student['email']}:{str(exc)}\n"
+                lines.append(f"send:{student['email']}\n")
+            else:
+                errors.append({"name": student["name"], "error": error})
+                lines.append(f"error:{student['email']}:{error}\n")
+        return lines
+
+    def skip_lines(skipped_rows: List[Tuple[int, Dict[str, str], str]]) -> Iterator[str]:
+        for _, student, reason in skipped_rows:
+            skipped.append({"name": student["name"], "reason": reason})
+            if student["email"] or reason == "Missing email":
+                yield f"skip:{student['email'] or student['name']}\n"
+        skipped_rows.clear()
+
+    async def event_stream():
+        pending = set()
+        try:
+            async for line in stream_deliveries(pending):
+                yield line
+        finally:
+            scheduler.cancel()
+            for task in pending:
+                task.cancel()
+
+    async def stream_deliveries(pending: set):
+        with RunProfiler(run_dir, profiling_requested(profile, x_diploma_profile)) as profiler:
+            skipped_rows = []
+            eligible = split_eligible(iter_csv_students(csv_file.file), selected, skipped_rows, campaign_key)
+            rendered = render_diplomas(eligible, pdf_path, jpg_template_path, run_dir, name_x_offset, name_y_offset)
+            groups = group_rendered(rendered, get_gmail_batch_size())
+            last_state = scheduler.snapshot()
+            while True:
+                if await request.is_disconnected():
+                    return
+                group = await run_in_threadpool(call_profiled, next, groups, None)
+                for line in skip_lines(skipped_rows):
+                    yield line
+                if group is None:
+                    break
+                for entry in group:
+                    count_pdf_output(pdf_output, entry[2])
+                pending.add(asyncio.ensure_future(deliver(group)))
+                if len(pending) >= concurrency:
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in [task for task in pending if task.done()]:
+                    pending.discard(task)
+                    for line in task.result():
+                        yield line
+                state = scheduler.snapshot()
+                if state["retries"] != last_state["retries"]:
+                    last_state = state
+                    yield f"rate:{state['rate']} retries={state['retries']} throttled={state['throttled']}\n"
+
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                for task in done:
+                    for line in task.result():
+                        yield line
 
         summary = {"sent": len(sent), "skipped": len(skipped)}
         try:
-            send_batch_notification(credentials, from_email, summary["sent"])
+            await run_in_threadpool(send_batch_notification, credentials, from_email, summary["sent"])
         except Exception as exc:  # noqa: BLE001
             yield f"notify_error:{str(exc)}\n"
+        state = scheduler.snapshot()
+        yield f"rate:{state['rate']} retries={state['retries']} throttled={state['throttled']}\n"
         yield f"summary: sent={summary['sent']} skipped={summary['skipped']}\n"
+        if profiler.report and "path" in profiler.report:
+            yield f"profile:{profiler.report['path']}\n"
         payload = {
             "sent_indices": sent_indices,
             "sent": sent,
             "skipped": skipped,
             "errors": errors,
             "summary": summary,
+            "scheduler": state,
+            "campaign": campaign_key,
+            "pdf_output": pdf_output,
+            "profile": profiler.report,
         }
         yield f"json:{json.dumps(payload)}\n"
 
     return StreamingResponse(event_stream(), media_type="text/plain")
 
 
+@app.post("/api/export")
+def export_diplomas(
+    csv_file: UploadFile = File(...),
+    pdf_template: Optional[UploadFile] = File(None),
+    jpg_template: Optional[UploadFile] = File(None),
+    pdf_asset_id: str = Form(""),
+    jpg_asset_id: str = Form(""),
+    export_format: str = Form("zip"),
+    selected_indices: str = Form(""),
+    name_x_offset: int = Form(0),
+    name_y_offset: int = Form(0),
+):
+    export_format = export_format.strip().lower()
+    if export_format not in EXPORT_FORMATS:
+        return JSONResponse({"ok": False, "error": "Export format must be zip or pdf."}, status_code=400)
+
+    try:
+        pdf_path = resolve_asset(pdf_template, pdf_asset_id)
+        jpg_template_path = resolve_asset(jpg_template, jpg_asset_id)
+    except FileNotFoundError as exc:
+        return JSONResponse({"ok": False, "error": str(exc)}, status_code=400)
+    if export_format == "pdf" and not pdf_path:
+        return JSONResponse({"ok": False, "error": "Missing PDF template."}, status_code=400)
+    if not pdf_path and not jpg_template_path:
+        return JSONResponse({"ok": False, "error": "Missing PDF or JPG template."}, status_code=400)
+
+    selected = parse_selected_indices(selected_indices)
+    eligible = split_eligible(iter_csv_students(csv_file.file), selected, deque(maxlen=0))
+    if export_format == "pdf":
+        body = iter_export_pdf(eligible, pdf_path, name_x_offset, name_y_offset)
+    else:
+        body = iter_export_zip(
+            render_diplomas(eligible, pdf_path, jpg_template_path, None, name_x_offset, name_y_offset)
+        )
+    filename = f"diplomas-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.on_event("startup")
+def startup_job_worker():
+    start_job_worker()
+
+
+@app.on_event("startup")
+def startup_output_janitor():
+    start_output_janitor()
+
+
+@app.on_event("startup")
+def startup_warm_up():
+    start_warm_up()
+
+
+@app.on_event("startup")
+def startup_credential_refresher():
+    start_credential_refresher()
+
+
+@app.get("/api/startup")
+def startup_report():
+    with STARTUP_LOCK:
+        stats = dict(STARTUP_STATS, warm_up=dict(STARTUP_STATS["warm_up"]))
+    return {
+        "ok": True,
+        "warm_up_enabled": warm_up_enabled(),
+        "import_seconds": round(stats["import_seconds"], 4),
+        "warm_up_seconds": stats["warm_up_seconds"],
+        "warm_up": stats["warm_up"],
+        "first_preview_seconds": stats["first_preview_seconds"],
+        "first_preview_since_import_seconds": stats["first_preview_since_import_seconds"],
+    }
+
+
+@app.get("/api/disk-usage")
+def disk_usage():
+    runs = list_output_runs() + list_assets()
+    kinds = {}
+    for kind in OUTPUT_RETENTION:
+        kind_runs = [run for run in runs if run["kind"] == kind]
+        kinds[kind] = {
+            "runs": len(kind_runs),
+            "bytes": sum(run["size"] for run in kind_runs),
+            "oldest": kind_runs[0]["name"] if kind_runs else None,
+            "newest": kind_runs[-1]["name"] if kind_runs else None,
+            "retention_hours": get_retention_hours(kind),
+        }
+    return {
+        "ok": True,
+        "output_dir": str(OUTPUT_DIR),
+        "assets_dir": str(ASSETS_DIR),
+        "total_bytes": directory_size(OUTPUT_DIR) + directory_size(ASSETS_DIR),
+        "runs_bytes": sum(run["size"] for run in runs),
+        "cap_bytes": get_output_cap_bytes(),
+        "kinds": kinds,
+    }
+
+
+@app.post("/api/disk-usage/cleanup")
+def disk_cleanup():
+    result = cleanup_output()
+    return {"ok": True, **result}
+
+
+@app.post("/api/jobs")
+def submit_job(
+    csv_file: UploadFile = File(...),
+    pdf_template: Optional[UploadFile] = File(None),
+    jpg_template: Optional[UploadFile] = File(None),
+    logo_file: Optional[UploadFile] = File(None),
+    pdf_asset_id: str = Form(""),
+    jpg_asset_id: str = Form(""),
+    logo_asset_id: str = Form(""),
+    html_content: str = Form(""),
+    text_content: str = Form(""),
+    letter_format: str = Form("html"),
+    subject: str = Form(""),
+    selected_indices: str = Form(""),
+    campaign: str = Form(""),
+    from_email: str = Form(""),
+    name_x_offset: int = Form(0),
+    name_y_offset: int = Form(0),
+):
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    run_dir = OUTPUT_DIR / f"batch-{run_id}"
+
+    try:
+        pdf_path = resolve_asset(pdf_template, pdf_asset_id)
+        jpg_template_path = resolve_asset(jpg_template, jpg_asset_id)
+        logo_path = resolve_asset(logo_file, logo_asset_id)
+    except FileNotFoundError as exc:
+        return JSONResponse({"ok": False, "error": str(exc)}, status_code=400)
+    if not pdf_path and not jpg_template_path:
+        return JSONResponse({"ok": False, "error": "Missing PDF or JPG template."}, status_code=400)
+
+    credentials = load_credentials()
+    if not credentials:
+        return JSONResponse({"ok": False, "error": "Not connected to Gmail. Click Connect Google first."}, status_code=400)
+
+    if not from_email:
+        try:
+            from_email = get_gmail_address(credentials)
+        except Exception:
+            from_email = ""
+
+    if not from_email:
+        return JSONResponse({"ok": False, "error": "Missing from email."}, status_code=400)
+
+    if letter_format == "text":
+        html_content = text_to_html(text_content)
+    if not html_content:
+        return JSONResponse({"ok": False, "error": "Letter content is empty."}, status_code=400)
+
+    logo_filename = None
+    if logo_path:
+        logo_filename = logo_path.name
+        html_content = inject_logo_cid(html_content)
+
+    students = iter_csv_students(csv_file.file)
+    params = {
+        "html_content": html_content,
+        "subject": subject,
+        "from_email": from_email,
+        "pdf_path": str(pdf_path) if pdf_path else None,
+        "jpg_template_path": str(jpg_template_path) if jpg_template_path else None,
+        "logo_path": str(logo_path) if logo_path else None,
+        "logo_filename": logo_filename,
+        "name_x_offset": name_x_offset,
+        "name_y_offset": name_y_offset,
+        "campaign": get_campaign_key(campaign, pdf_path, jpg_template_path),
+    }
+    start_job_worker()
+    job_id = create_job(run_dir, params, students, parse_selected_indices(selected_indices))
+    return {"ok": True, "job_id": job_id, "output_dir": str(run_dir)}
+
+
+@app.get("/api/jobs")
+def list_jobs(limit: int = 20):
+    init_jobs_db()
+    with jobs_db() as conn:
+        jobs = conn.execute(
+            "SELECT id, status, run_dir, error, created_at, updated_at FROM jobs ORDER BY created_at DESC LIMIT ?",
+            (max(1, min(limit, 200)),),
+        ).fetchall()
+    return {"ok": True, "jobs": [dict(job) for job in jobs]}
+
+
+@app.get("/api/jobs/{job_id}")
+def job_status(job_id: str):
+    init_jobs_db()
+    with jobs_db() as conn:
+        job = conn.execute(
+            "SELECT id, status, run_dir, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+    if job is None:
+        return JSONResponse({"ok": False, "error": "Unknown job."}, status_code=404)
+    return {"ok": True, "job": dict(job), **get_job_result(job_id)}
+
+
+@app.get("/api/jobs/{job_id}/stream")
+async def job_stream(job_id: str, after: int = 0):
+    await run_in_threadpool(init_jobs_db)
+    _, status = await run_in_threadpool(read_job_events, job_id, 0)
+    if status is None:
+        return JSONResponse({"ok": False, "error": "Unknown job."}, status_code=404)
+
+    async def event_stream():
+        last_id = after
+        while True:
+            events, status = await run_in_threadpool(read_job_events, job_id, last_id)
+            for event_id, line in events:
+                last_id = event_id
+                yield f"{line}\n"
+            if status in JOB_TERMINAL_STATUSES and not events:
+                result = await run_in_threadpool(get_job_result, job_id)
+                yield f"json:{json.dumps({'job_id': job_id, 'status': status, **result})}\n"
+                return
+            await asyncio.sleep(JOB_STREAM_POLL_SECONDS)
+
+    return StreamingResponse(event_stream(), media_type="text/plain")
+
+
+@app.post("/api/jobs/{job_id}/resume")
+def resume_job(job_id: str, resend_interrupted: str = Form("")):
+    init_jobs_db()
+    requeued = 0
+    with jobs_db() as conn:
+        job = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return JSONResponse({"ok": False, "error": "Unknown job."}, status_code=404)
+        if job["status"] in {"queued", "running"}:
+            return JSONResponse({"ok": False, "error": f"Job is already {job['status']}."}, status_code=409)
+        if resend_interrupted.strip().lower() in {"1", "true", "yes"}:
+            requeued = conn.execute(
+                "UPDATE job_rows SET status = 'pending', detail = '', updated_at = ? WHERE job_id = ? AND status = 'interrupted'",
+                (time.time(), job_id),
+            ).rowcount
+        conn.execute("UPDATE jobs SET status = 'queued', error = '', updated_at = ? WHERE id = ?", (time.time(), job_id))
+    start_job_worker()
+    JOB_WAKEUP.set()
+    return {"ok": True, "job_id": job_id, "requeued_interrupted": requeued}
+
+
 @app.post("/api/save-csv")
 def save_csv(
     csv_content: str = Form(...),
@@ -96,6 +96,34 @@ const syncFormatPanels = () => {
   textPanel.classList.toggle("hidden", format !== "text");
 };
 
+const assetIds = new WeakMap();
+const uploadAsset = async (file) => {
+  if (assetIds.has(file)) return assetIds.get(file);
+  const data = new FormData();
+  data.set("file", file);
+  const response = await fetch("/api/assets", { method: "POST", body: data });
+  const payload = await response.json();
+  if (!response.ok || !payload.ok) {
+    throw new Error(payload.error || "Failed to upload file");
+  }
+  assetIds.set(file, payload.id);
+  return payload.id;
+};
+
+const applyAssetIds = async (data) => {
+  const fields = [
+    [pdfInput, "pdf_template", "pdf_asset_id"],
+    [jpgInput, "jpg_template", "jpg_asset_id"],
+    [logoInput, "logo_file", "logo_asset_id"],
+  ];
+  for (const [input, fileField, idField] of fields) {
+    data.delete(fileField);
+    if (input && input.files.length) {
+      data.set(idField, await uploadAsset(input.files[0]));
+    }
+  }
+};
+
 let pdfPreviewTimer = null;
 const updatePdfPreview = async () => {
   if (!pdfPreview) return;
@@ -116,12 +144,6 @@ const updatePdfPreview = async () => {
     return;
   }
   const data = new FormData();
-  if (hasPdf) {
-    data.set("pdf_template", pdfInput.files[0]);
-  }
-  if (hasJpg) {
-    data.set("jpg_template", jpgInput.files[0]);
-  }
   data.set("test_name", testNameInput.value.trim());
   if (nameXOffsetInput) {
     data.set("name_x_offset", nameXOffsetInput.value || "0");
@@ -132,6 +154,12 @@ const updatePdfPreview = async () => {
 
   log.textContent = "Generating PDF preview...";
   try {
+    if (hasPdf) {
+      data.set("pdf_asset_id", await uploadAsset(pdfInput.files[0]));
+    }
+    if (hasJpg) {
+      data.set("jpg_asset_id", await uploadAsset(jpgInput.files[0]));
+    }
     const response = await fetch("/api/preview-pdf", { method: "POST", body: data });
     const payload = await response.json();
     if (!response.ok || !payload.ok) {
@@ -370,6 +398,7 @@ const sendFormData = async (endpoint, options = {}) => {
 
   log.textContent = "Sending...";
   try {
+    await applyAssetIds(data);
     const response = await fetch(endpoint, { method: "POST", body: data });
     const payload = await response.json();
     if (!response.ok) {
@@ -412,6 +441,7 @@ const sendBatchStream = async () => {
 
   log.textContent = "Sending batch...";
   try {
+    await applyAssetIds(data);
     const response = await fetch("/api/send-stream", { method: "POST", body: data });
     if (!response.ok) {
       const payload = await response.json().catch(() => ({}));